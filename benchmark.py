@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Reproducible rendering benchmarks of the solar system scene and stress
+variants, run headless at a fixed time step. Each scene runs in its own
+process, for a clean GL context and a meaningful peak memory. Results can
+be saved as a baseline and later runs compared against it.
+"""
+# Python built-in modules
+import argparse                     # command line options
+import json                         # results & baseline format
+import resource                     # peak resident memory
+import subprocess                   # one process per scene
+import sys
+import time                         # load time
+
+ROCKET = 'objet3D/rocket_v1_L2.123c433550fa-0038-410c-a891-3367406a58a6/12216_rocket_v1_l2.obj'
+MOON = 'objet3D/Moon/Moon2K.obj'
+RESULTS = 'BENCHMARK RESULTS '  # tags scene process results output line
+
+# default suite, as scene:count
+SUITE = ['solar', 'orbits:100', 'orbits:1000', 'particles:10000',
+         'particles:100000', 'particles:1000000', 'gpuparticles:100000',
+         'gpuparticles:1000000', 'rocket']
+
+# metric => True if higher is better, for baseline comparisons
+METRICS = {'load': False, 'fps': True, 'frame p50': False, 'frame p95': False,
+           'frame p99': False, 'rss': False}
+
+
+# -------------- benchmark scenes ----------------------------------------------
+def solar(viewer, count):
+    """ the stock viewer scene """
+    from viewer import populate
+    populate(viewer)
+
+
+def orbits(viewer, count):
+    """ count moons orbiting a common center, at various distances """
+    from node import Node
+    from space import PlaneteTransform
+    import numpy as np
+    system = Node(transform=np.diag((1e-4, 1e-4, 1e-4, 1)).astype('f'))
+    for i in range(count):
+        angle = 2 * np.pi * i / count
+        start = np.array([np.cos(angle), np.sin(angle), 0]) * (3000 + 20 * i)
+        system.add(PlaneteTransform(MOON, np.array([1, 1, 1]), 2 + i % 5,
+                                    start, 100, np.array([0, 0, 1]),
+                                    10 + i % 50, 100))
+    viewer.add(system)
+
+
+def particles(viewer, count):
+    """ one emitter of count particles """
+    from particlesbis import ParticleGenerator
+    viewer.add(ParticleGenerator(file='particle/p.png', amount=count))
+
+
+def gpuparticles(viewer, count):
+    """ one emitter of count particles simulated on the GPU """
+    from gpuparticles import GPUParticleGenerator
+    viewer.add(GPUParticleGenerator(file='particle/p.png', amount=count))
+
+
+def rocket(viewer, count):
+    """ the largest model of the project """
+    from loader import assets
+    from node import Node
+    viewer.add(assets.load_textured(ROCKET, Node()))
+
+
+SCENES = {'solar': (solar, 0), 'orbits': (orbits, 200),
+          'particles': (particles, 10000),
+          'gpuparticles': (gpuparticles, 100000), 'rocket': (rocket, 0)}
+
+
+def run_scene(scene, frames, size, step):
+    """ load and render scene in this process, returns its measures """
+    import headless  # sets up GL platform: only imported by scene process
+    import numpy as np
+    from loader import assets
+    from profiler import profiler
+
+    name, _, count = scene.partition(':')
+    build, default = SCENES[name]
+    viewer = headless.HeadlessViewer(*size, step)
+    np.random.seed(0)
+
+    start = time.perf_counter()
+    build(viewer, int(count) if count else default)
+    assets.finish()
+    load = time.perf_counter() - start
+
+    viewer.run(min(frames, 10))  # warm up: lazy allocations, driver caches
+    profiler.frames.clear()
+    fps = viewer.run(frames)
+    frame = profiler.stats()['frame']
+    # ru_maxrss is in kilobytes on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {'load': load, 'fps': fps, 'frame p50': frame['p50'],
+            'frame p95': frame['p95'], 'frame p99': frame['p99'], 'rss': rss}
+
+
+def compare(results, baseline, tolerance):
+    """ print results next to baseline, returns list of regressions """
+    regressions = []
+    print('%-20s' % 'scene' + ''.join('%18s' % name for name in METRICS))
+    for scene, measures in results.items():
+        line = '%-20s' % scene
+        for name, higher in METRICS.items():
+            value, cell = measures[name], '%.2f' % measures[name]
+            reference = baseline.get(scene, {}).get(name)
+            if reference:
+                change = value / reference - 1
+                cell += ' (%+.0f%%)' % (100 * change)
+                if (-change if higher else change) > tolerance:
+                    regressions.append((scene, name, reference, value))
+                    cell += '!'
+            line += '%18s' % cell
+        print(line)
+    return regressions
+
+
+# -------------- main program ---------------------------------------------------
+def main():
+    """ run benchmark scenes, each in a child process """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('scenes', nargs='*', default=SUITE,
+                        help='scene[:count] among %s' % ', '.join(SCENES))
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--size', default='640x480', help='WIDTHxHEIGHT')
+    parser.add_argument('--step', type=float, default=1/60,
+                        help='frame time step, in seconds')
+    parser.add_argument('--output', help='save results to this JSON file')
+    parser.add_argument('--baseline', help='compare to results JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative change reported as regression')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    size = tuple(int(n) for n in args.size.split('x'))
+
+    if args.child:  # single scene, results on a tagged output line
+        results = run_scene(args.scenes[0], args.frames, size, args.step)
+        print(RESULTS + json.dumps(results), flush=True)
+        return
+
+    results = {}
+    for scene in args.scenes:
+        command = [sys.executable, __file__, scene, '--child',
+                   '--frames', str(args.frames), '--size', args.size,
+                   '--step', str(args.step)]
+        process = subprocess.run(command, stdout=subprocess.PIPE,
+                                 universal_newlines=True)
+        if process.returncode:
+            print('ERROR: benchmark %s failed' % scene)
+            continue
+        lines = [line for line in process.stdout.split('\n')
+                 if line.startswith(RESULTS)]
+        results[scene] = json.loads(lines[0][len(RESULTS):])
+        print('%s: %.1f frames/s' % (scene, results[scene]['fps']))
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    regressions = compare(results, baseline, args.tolerance)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    for scene, name, reference, value in regressions:
+        print('REGRESSION %s %s: %.2f -> %.2f' % (scene, name, reference, value))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Simulation clock shared by all animated objects.
+Simulation state advances by fixed time steps, as many as elapsed frame time
+calls for, independently of the frame rate. Frame time follows the GLFW wall
+clock in the interactive viewer, or advances by a fixed frame step for
+reproducible, display free rendering. Rendering samples animations at the
+time between the last two steps, for smooth motion at any frame rate.
+"""
+# External, non built-in modules
+import glfw                 # lean window system wrapper for OpenGL
+
+
+class Clock:
+    """ Fixed step simulation time, driven by frame time, scalable &
+        pausable. Frame time is GLFW time, or fixed increments if
+        frame_step is set """
+    def __init__(self, step=1/60, frame_step=None, max_steps=8):
+        self.step, self.frame_step = step, frame_step
+        self.max_steps = max_steps  # per frame at scale 1, if too slow
+        self.scale, self.paused = 1., False
+        self.time = 0.              # simulation time of current state
+        self.wall = None            # GLFW time of last tick
+        self.accumulator = 0.       # scaled frame time not simulated yet
+        self.pending = 0            # single steps requested while paused
+
+    def tick(self):
+        """ advance to the time of a new frame, returns the number of fixed
+            steps due, to be run by calling advance before each update """
+        if self.frame_step:
+            elapsed = self.frame_step
+        else:
+            wall = glfw.get_time()
+            elapsed = wall - self.wall if self.wall is not None else 0.
+            self.wall = wall
+        if not self.paused:
+            self.accumulator += elapsed * self.scale
+
+        # tolerance: rounding must not delay a step whose time has come
+        steps = int(self.accumulator / self.step + 1e-6)
+        limit = int(self.max_steps * max(1., self.scale))
+        if steps > limit:  # can't keep up: slow down rather than stall
+            steps, self.accumulator = limit, limit * self.step
+        self.accumulator = max(self.accumulator - steps * self.step, 0.)
+        steps, self.pending = steps + self.pending, 0
+        return steps
+
+    def advance(self):
+        """ move simulation time one step forward """
+        self.time += self.step
+
+    def get_time(self):
+        """ simulation time of current state, in seconds """
+        return self.time
+
+    def get_render_time(self):
+        """ time to render animations at, between current & next step """
+        return self.time + self.accumulator
+
+    def pause(self, paused=None):
+        """ pause or resume simulation, toggled if paused is None """
+        self.paused = not self.paused if paused is None else paused
+
+    def single_step(self):
+        """ request one step on next tick, e.g. while paused """
+        self.pending += 1
+
+    def set_scale(self, scale):
+        """ simulated seconds per frame time second """
+        self.scale = max(scale, 0.)
+
+    def reset(self, time=0.):
+        """ restart simulation from given time """
+        self.time, self.accumulator, self.pending = time, 0., 0
+
+
+clock = Clock()  # clock shared by the whole process
@@ -0,0 +1,177 @@
+# External, non built-in modules
+import ctypes                       # buffer offsets of particle fields
+import OpenGL.GL as GL              # standard Python OpenGL wrapper
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+from vertex import *
+from shader import shaders
+from particles import ParticleArrays
+from render import queue, TRANSPARENT, ADDITIVE
+
+# -------------- Particle update shader ---------------------------------------
+# one vertex per particle, advanced like particlesbis.ParticleGenerator does
+# on the CPU: moved & aged, then respawned around offset once dead
+PARTICLE_UPDATE_VERT = """#version 330 core
+uniform float dt;
+uniform int frame;          // varies the respawn random numbers
+uniform float spread;
+uniform float shade;
+uniform vec3 offset;
+
+layout(location = 0) in vec3 position;
+layout(location = 1) in vec3 velocity;
+layout(location = 2) in vec4 color;
+layout(location = 3) in float life;
+
+out vec3 out_position;
+out vec3 out_velocity;
+out vec4 out_color;
+out float out_life;
+
+uint hash(uint x) {         // integer hash, same results on any driver
+    x ^= x >> 16u; x *= 0x7feb352du;
+    x ^= x >> 15u; x *= 0x846ca68bu;
+    x ^= x >> 16u;
+    return x;
+}
+
+void main() {
+    out_position = position - velocity * dt;
+    out_velocity = velocity;
+    out_color = color;
+    out_life = life - dt;
+    if (out_life <= 0.) {
+        uint seed = hash(uint(gl_VertexID) ^ hash(uint(frame)));
+        float jitter = float(seed % 100u);
+        float tint = float(hash(seed) % 100u);
+        out_position = vec3((jitter - 50.) / spread) + offset;
+        out_velocity = vec3(0, 0.1, 0);
+        out_color = vec4(vec3(0.5 + tint / shade), 1);
+        out_life = 1.;
+    }
+}"""
+
+# particle state fields, interleaved in this order: name, components
+PARTICLE_FIELDS = (('position', 3), ('velocity', 3), ('color', 4), ('life', 1))
+PARTICLE_STRIDE = 4 * sum(size for _, size in PARTICLE_FIELDS)
+
+
+class ParticleStateArray:
+    """ Vertex array reading the particle states of a buffer, either one
+        vertex per particle to update them, or as per instance offset and
+        color of a quad, to draw them """
+    def __init__(self, state, amount, quad=None):
+        self.glid = GL.glGenVertexArrays(1)
+        self.amount = amount
+        GL.glBindVertexArray(self.glid)
+        if quad is not None:  # quad position & texture coordinates
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, quad)
+            for loc in (0, 1):
+                GL.glEnableVertexAttribArray(loc)
+                GL.glVertexAttribPointer(loc, 2, GL.GL_FLOAT, False, 16,
+                                         ctypes.c_void_p(8 * loc))
+
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, state)
+        offset, fields = 0, {}
+        for name, size in PARTICLE_FIELDS:
+            fields[name] = (size, offset)
+            offset += 4 * size
+        # update reads all fields, drawing only position & color
+        locations = (('position', 2), ('color', 3)) if quad is not None \
+            else ((name, loc) for loc, (name, _) in enumerate(PARTICLE_FIELDS))
+        for name, loc in locations:
+            size, offset = fields[name]
+            GL.glEnableVertexAttribArray(loc)
+            GL.glVertexAttribPointer(loc, size, GL.GL_FLOAT, False,
+                                     PARTICLE_STRIDE, ctypes.c_void_p(offset))
+            if quad is not None:
+                GL.glVertexAttribDivisor(loc, 1)
+        GL.glBindVertexArray(0)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+
+    def draw(self, primitive, instances=None, level=0):
+        """ draw already bound array: all particles as points, or instances
+            of the quad """
+        profiler.count('draw calls')
+        if instances is None:
+            GL.glDrawArrays(primitive, 0, self.amount)
+        else:
+            GL.glDrawArraysInstanced(primitive, 0, 6, instances)
+
+    def __del__(self):
+        GL.glDeleteVertexArrays(1, [self.glid])
+
+
+# -----------------------------------------------------------------------------
+class GPUParticleGenerator:
+    """ particle emitter whose particles live in GPU buffers only: each
+        update step runs the update shader over all particles, capturing its
+        output to the other buffer of a pair by transform feedback. Drawing
+        reads the last written buffer, so nothing is uploaded per frame """
+
+    def __init__(self, file, amount=100000, life=1.0, spread=50.0,
+                 shade=200.0):
+        self.amount, self.spread, self.shade = amount, spread, shade
+        self.offset = np.array((0, 0, 0), 'f')
+        self.texture = textures.acquire(file)
+        self.update_shader = shaders.acquire(
+            PARTICLE_UPDATE_VERT, None,
+            varyings=['out_' + name for name, _ in PARTICLE_FIELDS])
+
+        # same initial state as the CPU particles
+        particles = ParticleArrays(amount, life=life)
+        state = np.hstack([particles.position, particles.velocity,
+                           particles.color, particles.life[:, None]])
+        state = np.ascontiguousarray(state, np.float32)
+
+        quad = np.array(((0,1, 0,1), (1,0, 1,0), (0,0, 0,0),
+                         (0,1, 0,1), (1,1, 1,1), (1,0, 1,0)), 'f')
+        self.buffers = GL.glGenBuffers(3)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[2])
+        GL.glBufferData(GL.GL_ARRAY_BUFFER, quad, GL.GL_STATIC_DRAW)
+        for buffer in self.buffers[:2]:  # ping-pong particle states
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, buffer)
+            GL.glBufferData(GL.GL_ARRAY_BUFFER, state, GL.GL_DYNAMIC_COPY)
+        profiler.count('uploaded bytes', quad.nbytes + 2 * state.nbytes)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+
+        self.sources = [ParticleStateArray(buffer, amount)
+                        for buffer in self.buffers[:2]]
+        self.arrays = [ParticleStateArray(buffer, amount, self.buffers[2])
+                       for buffer in self.buffers[:2]]
+        self.current, self.frame = 0, 0  # buffer of latest states
+
+    def update(self, dt=0.0, obj=0, newParticles=2, offset=None):
+        """ advance all particles by dt on the GPU, without drawing """
+        if offset is not None:
+            self.offset = offset
+        GL.glUseProgram(self.update_shader.glid)
+        self.update_shader.set_uniforms(dt=dt, frame=self.frame,
+                                        spread=self.spread, shade=self.shade,
+                                        offset=self.offset)
+        target = 1 - self.current
+        GL.glEnable(GL.GL_RASTERIZER_DISCARD)
+        GL.glBindVertexArray(self.sources[self.current].glid)
+        GL.glBindBufferBase(GL.GL_TRANSFORM_FEEDBACK_BUFFER, 0,
+                            self.buffers[target])
+        GL.glBeginTransformFeedback(GL.GL_POINTS)
+        self.sources[self.current].draw(GL.GL_POINTS)
+        GL.glEndTransformFeedback()
+        GL.glBindBufferBase(GL.GL_TRANSFORM_FEEDBACK_BUFFER, 0, 0)
+        GL.glBindVertexArray(0)
+        GL.glDisable(GL.GL_RASTERIZER_DISCARD)
+        self.current, self.frame = target, self.frame + 1
+
+    def draw(self, projection, view, model, **param):
+        self.shader = param['texture_shader_particle']
+
+        # additive blending for a 'glow' effect, once opaque objects are drawn
+        queue.submit(self.shader, self.arrays[self.current],
+                     dict(projection=projection, sprite=0),
+                     [(GL.GL_TEXTURE_2D, self.texture, None)],
+                     layer=TRANSPARENT, blend=ADDITIVE, instances=self.amount)
+
+    def __del__(self):
+        GL.glDeleteBuffers(3, self.buffers)
+        shaders.release(self.update_shader)
+        textures.release(self.texture)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Headless offscreen rendering of the viewer scene, for batch frame export.
+Renders into a framebuffer object through an EGL or OSMesa software context,
+at a fixed simulated time step, and streams frames out to PNG files or a raw
+RGBA video file through asynchronous pixel buffer readback.
+"""
+# Python built-in modules
+import argparse                     # command line options
+import ctypes                       # EGL & OSMesa attribute lists
+import os                           # os function, i.e. checking file status
+import sys
+import time                         # rendering throughput
+
+# PyOpenGL picks its platform once, when OpenGL is first imported: must be
+# set before importing any of our modules
+os.environ.setdefault('PYOPENGL_PLATFORM',
+                      'osmesa' if '--osmesa' in sys.argv else 'egl')
+if os.environ['PYOPENGL_PLATFORM'] == 'egl':
+    os.environ.setdefault('EGL_PLATFORM', 'surfaceless')  # no display server
+
+# External, non built-in modules
+import OpenGL.GL as GL              # standard Python OpenGL wrapper
+import numpy as np                  # all matrix manipulations & OpenGL args
+from PIL import Image               # load images for textures
+
+from transform import Trackball
+from clock import clock
+from loader import assets
+from profiler import profiler
+from viewer import Viewer, populate
+
+
+def egl_context():
+    """ OpenGL 3.3 core context without any surface, made current """
+    from OpenGL import EGL
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    major, minor = EGL.EGLint(), EGL.EGLint()
+    if not EGL.eglInitialize(display, ctypes.pointer(major),
+                             ctypes.pointer(minor)):
+        raise RuntimeError('EGL initialization failed')
+
+    attributes = (EGL.EGLint * 5)(EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                                  EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                                  EGL.EGL_NONE)
+    config, count = EGL.EGLConfig(), EGL.EGLint()
+    EGL.eglChooseConfig(display, attributes, ctypes.pointer(config), 1,
+                        ctypes.pointer(count))
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    attributes = (EGL.EGLint * 7)(
+        EGL.EGL_CONTEXT_MAJOR_VERSION, 3, EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+        EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK,
+        EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT, EGL.EGL_NONE)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT,
+                                   attributes)
+    if not context or not EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE,
+                                             EGL.EGL_NO_SURFACE, context):
+        raise RuntimeError('EGL OpenGL 3.3 core context creation failed')
+    return display, context
+
+
+def osmesa_context(width, height):
+    """ OpenGL 3.3 core OSMesa context, made current on a client buffer """
+    from OpenGL import osmesa
+    attributes = (ctypes.c_int * 11)(
+        osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+        osmesa.OSMESA_DEPTH_BITS, 24,
+        osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+        osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 3,
+        osmesa.OSMESA_CONTEXT_MINOR_VERSION, 3, 0)
+    context = osmesa.OSMesaCreateContextAttribs(attributes, None)
+    buffer = np.zeros((height, width, 4), np.uint8)  # must outlive context
+    if not context or not osmesa.OSMesaMakeCurrent(
+            context, buffer, GL.GL_UNSIGNED_BYTE, width, height):
+        raise RuntimeError('OSMesa OpenGL 3.3 core context creation failed')
+    return context, buffer
+
+
+class Framebuffer:
+    """ Offscreen color & depth render target, bound for drawing """
+    def __init__(self, width, height):
+        self.glid = GL.glGenFramebuffers(1)
+        self.buffers = GL.glGenRenderbuffers(2)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.glid)
+        for buffer, storage, attachment in (
+                (self.buffers[0], GL.GL_RGBA8, GL.GL_COLOR_ATTACHMENT0),
+                (self.buffers[1], GL.GL_DEPTH_COMPONENT24, GL.GL_DEPTH_ATTACHMENT)):
+            GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, buffer)
+            GL.glRenderbufferStorage(GL.GL_RENDERBUFFER, storage, width, height)
+            GL.glFramebufferRenderbuffer(GL.GL_FRAMEBUFFER, attachment,
+                                         GL.GL_RENDERBUFFER, buffer)
+        status = GL.glCheckFramebufferStatus(GL.GL_FRAMEBUFFER)
+        if status != GL.GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError('incomplete framebuffer (%#x)' % status)
+        GL.glViewport(0, 0, width, height)
+
+    def __del__(self):
+        GL.glDeleteRenderbuffers(2, self.buffers)
+        GL.glDeleteFramebuffers(1, [self.glid])
+
+
+class FrameReader:
+    """ Asynchronous readback of frames through a ring of pixel buffers:
+        a frame is copied to a buffer by the GPU, and only fetched by the
+        CPU when its buffer is reused, frames later, so reading never waits
+        for the frame being rendered """
+    def __init__(self, width, height, write, count=3):
+        self.width, self.height, self.write = width, height, write
+        self.size = width * height * 4
+        self.buffers = GL.glGenBuffers(count)
+        self.queue = []  # (buffer, fence, frame number) read, oldest first
+        for buffer in self.buffers:
+            GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, buffer)
+            GL.glBufferData(GL.GL_PIXEL_PACK_BUFFER, self.size, None,
+                            GL.GL_STREAM_READ)
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+
+    def read(self, frame):
+        """ start reading current framebuffer content as given frame """
+        if len(self.queue) == len(self.buffers):
+            self.fetch()
+        buffer = self.buffers[frame % len(self.buffers)]
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, buffer)
+        GL.glReadPixels(0, 0, self.width, self.height, GL.GL_RGBA,
+                        GL.GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+        fence = GL.glFenceSync(GL.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.queue.append((buffer, fence, frame))
+
+    def fetch(self):
+        """ write out oldest frame read, waiting for its copy if needed """
+        buffer, fence, frame = self.queue.pop(0)
+        GL.glClientWaitSync(fence, GL.GL_SYNC_FLUSH_COMMANDS_BIT,
+                            GL.GL_TIMEOUT_IGNORED)
+        GL.glDeleteSync(fence)
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, buffer)
+        pixels = GL.glGetBufferSubData(GL.GL_PIXEL_PACK_BUFFER, 0, self.size)
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+        # OpenGL rows start from the bottom of the image
+        image = np.frombuffer(pixels, np.uint8).reshape(
+            self.height, self.width, 4)[::-1]
+        self.write(frame, image)
+
+    def finish(self):
+        """ write out all frames still being read """
+        while self.queue:
+            self.fetch()
+
+
+class ImageWriter:
+    """ Writes frames as numbered images, format given by file extension """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        os.makedirs(os.path.dirname(pattern) or '.', exist_ok=True)
+
+    def __call__(self, frame, image):
+        Image.fromarray(image).save(self.pattern % frame)
+
+    def close(self):
+        pass
+
+
+class RawWriter:
+    """ Writes frames one after the other as raw RGBA video, e.g. for
+        ffmpeg -f rawvideo -pix_fmt rgba -s WIDTHxHEIGHT -i file """
+    def __init__(self, file):
+        self.file = open(file, 'wb')
+
+    def __call__(self, frame, image):
+        self.file.write(np.ascontiguousarray(image).data)
+
+    def close(self):
+        self.file.close()
+
+
+class HeadlessViewer(Viewer):
+    """ Viewer rendering offscreen at a fixed time step, without window """
+
+    def __init__(self, width=640, height=480, step=1/30, platform=None):
+        """ step: frame time increment, simulation steps being those of
+            clock, e.g. 2 simulation steps per frame at default 1/30 """
+        platform = platform or os.environ['PYOPENGL_PLATFORM']
+        self.size = width, height
+        self.context = egl_context() if platform == 'egl' \
+            else osmesa_context(width, height)
+        self.framebuffer = Framebuffer(width, height)
+        self.win = None  # drawables skip interactive controls
+        self.init_gl()
+        self.trackball = Trackball()
+        clock.frame_step = step
+        clock.reset()
+
+    def run(self, frames, write=None):
+        """ render given number of frames, each written by write(frame,
+            image) if given. Returns the number of frames per second """
+        reader = FrameReader(*self.size, write) if write else None
+        start = time.perf_counter()
+        for frame in range(frames):
+            self.frame(self.size)
+            if reader:
+                reader.read(frame)
+        if reader:
+            reader.finish()
+        GL.glFinish()
+        return frames / (time.perf_counter() - start)
+
+
+# -------------- main program and scene setup --------------------------------
+def main():
+    """ render the viewer scene offscreen to files """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('output', nargs='?', help='image file pattern such '
+                        'as frames/%%05d.png, or raw RGBA video file')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--step', type=float, default=1/30,
+                        help='frame time step, in seconds')
+    parser.add_argument('--scale', type=float, default=1.,
+                        help='simulated seconds per frame time second')
+    parser.add_argument('--skip', type=float, default=0.,
+                        help='simulated seconds to skip before first frame')
+    parser.add_argument('--size', default='640x480', help='WIDTHxHEIGHT')
+    parser.add_argument('--osmesa', action='store_true',
+                        help='OSMesa context instead of EGL')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--profile', help='frame statistics output file, '
+                        'JSON or per frame CSV if ending with .csv')
+    parser.add_argument('--per-node', action='store_true',
+                        help='also time each scene node & render item')
+    args = parser.parse_args()
+    profiler.detailed = args.per_node
+
+    width, height = (int(n) for n in args.size.split('x'))
+    viewer = HeadlessViewer(width, height, args.step)
+    np.random.seed(args.seed)  # reproducible particles
+    populate(viewer)
+    assets.finish()  # all models present from first frame
+    clock.set_scale(args.scale)
+    viewer.simulate(args.skip)
+
+    writer = None
+    if args.output:
+        writer = ImageWriter(args.output) if '%' in args.output \
+            else RawWriter(args.output)
+    fps = viewer.run(args.frames, writer)
+    if writer:
+        writer.close()
+    print('Rendered %d frames (%dx%d) at %.1f frames/s'
+          % (args.frames, width, height, fps))
+    print(profiler.summary())
+    if args.profile:
+        profiler.export(args.profile)
+
+
+if __name__ == '__main__':
+    main()
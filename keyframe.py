@@ -1,20 +1,40 @@
 from transform import translate, rotate, scale, lerp, vec, lerpCircle
 from transform import (quaternion_slerp, quaternion_matrix, quaternion,
                        quaternion_from_euler)
+from transform import (batch_lerpCircle, batch_quaternion_slerp,
+                       batch_quaternion_matrix)
 from node import Node
 import glfw
-from bisect import bisect_left
+import numpy as np
 
 
 class KeyFrames:
-    """ Stores keyframe pairs for any value type with interpolation_function"""
-    def __init__(self, time_value_pairs, interpolation_function=lerp):
+    """ Stores keyframe pairs for any value type with interpolation_function.
+        Keys are kept in arrays with spare capacity, so that appending is
+        amortized O(1). With a window duration, keys older than the interval
+        containing last key time - window are dropped while appending """
+    def __init__(self, time_value_pairs, interpolation_function=lerp,
+                 window=None):
         if isinstance(time_value_pairs, dict):  # convert to list of pairs
             time_value_pairs = time_value_pairs.items()
         keyframes = sorted(((key[0], key[1]) for key in time_value_pairs))
-        self.times, self.values = zip(*keyframes)  # pairs list -> 2 lists
+        times, values = zip(*keyframes)  # pairs list -> 2 lists
+        self._times, self._values = np.array(times, float), np.array(values, float)
+        self.start, self.end = 0, len(times)  # used part of arrays
+        self.window = window
+        self.version = 0  # incremented whenever keys change
         self.interpolate = interpolation_function
 
+    @property
+    def times(self):
+        """ key times, in increasing order """
+        return self._times[self.start:self.end]
+
+    @property
+    def values(self):
+        """ key values, in times order """
+        return self._values[self.start:self.end]
+
     def value(self, time):
         """ Computes interpolated value from keyframes, for a given time """
 
@@ -23,8 +43,8 @@ class KeyFrames:
             print("Mauvaise utilisation interpolation")
             exit(0)
 
-        # 2. search for closest index entry in self.times, using bisect_left function
-        position = bisect_left(self.times, time)
+        # 2. search for closest index entry in self.times, like bisect_left
+        position = np.searchsorted(self.times, time)
         # 3. using the retrieved index, interpolate between the two neighboring values
         # in self.values, using the initially stored self.interpolate function
         fraction = (time - self.times[position - 1])/(self.times[position] - self.times[position-1])
@@ -36,31 +56,59 @@ class KeyFrames:
         # 1. ensure time is within bounds else return boundary keyframe
         taille = self.times[len(self.times)-1]
         time2 = time % taille
-        # 2. search for closest index entry in self.times, using bisect_left function
-        position = bisect_left(self.times, time2)
+        # 2. search for closest index entry in self.times, like bisect_left
+        position = np.searchsorted(self.times, time2)
         # 3. using the retrieved index, interpolate between the two neighboring values
         # in self.values, using the initially stored self.interpolate function
         fraction = (time2 - self.times[position - 1])/(self.times[position] - self.times[position-1])
         return self.interpolate(self.values[position -1], self.values[position], fraction)
 
     def add_value(self, time, value):
-        self.times = self.times + (time,)
-        self.values = self.values + (value,)
+        """ append a key after the last one """
+        if self.end == len(self._times):
+            self.reserve()
+        self._times[self.end], self._values[self.end] = time, value
+        self.end += 1
+        if self.window is not None:
+            self.trim(time - self.window)
+        self.version += 1
+
+    def reserve(self):
+        """ room for more keys at the end of arrays: move keys to front if
+            at least half of capacity is free, else double capacity """
+        count = self.end - self.start
+        if 2 * count > len(self._times):
+            times = np.empty(2 * len(self._times))
+            values = np.empty((2 * len(self._values),) + self._values.shape[1:])
+        else:
+            times, values = self._times, self._values
+        times[:count], values[:count] = self.times, self.values
+        self._times, self._values = times, values
+        self.start, self.end = 0, count
+
+    def trim(self, time):
+        """ drop keys before the interval containing time, keeping two """
+        first = self.start + np.searchsorted(self.times, time, 'right') - 1
+        if min(first, self.end - 2) > self.start:
+            self.start = min(first, self.end - 2)
+            self.version += 1
 
     def get_Taille_time(self):
-        return self.times[len(self.times)-1]
+        return self._times[self.end-1]
 
     def get_last_value(self):
-        return self.values[len(self.values)-1]
+        return self._values[self.end-1].copy()
 
 
 class TransformKeyFrames:
     """ KeyFrames-like object dedicated to 3D transforms """
-    def __init__(self, translate_keys, rotate_keys, scale_keys, interpolation_translate=lerp):
+    def __init__(self, translate_keys, rotate_keys, scale_keys, interpolation_translate=lerp,
+                 window=None):
         """ stores 3 keyframe sets for translation, rotation, scale """
-        self.translation = KeyFrames(translate_keys, interpolation_translate)
-        self.rotation = KeyFrames(rotate_keys, quaternion_slerp)
-        self.scale = KeyFrames(scale_keys)
+        self.translation = KeyFrames(translate_keys, interpolation_translate,
+                                     window)
+        self.rotation = KeyFrames(rotate_keys, quaternion_slerp, window)
+        self.scale = KeyFrames(scale_keys, window=window)
 
     def value(self, time):
         """ Compute each component's interpolation and compose TRS matrix """
@@ -108,22 +156,118 @@ class TransformKeyFrames:
     def get_trans(self):
         return self.translation
 
+class KeyFrameTracks:
+    """ KeyFrames of many nodes packed in padded arrays, one row per track.
+        Rows are offset in time so that all keys form one sorted array,
+        searched at once by np.searchsorted for every track """
+    def __init__(self, tracks, size):
+        self.tracks, self.size = tracks, size
+        self.packed = [None] * len(tracks)  # track version packed in rows
+        self.rows = np.arange(len(tracks))
+        self.capacity, self.bound = 0, 0.
+        self.update()
+
+    def update(self):
+        """ repack rows of tracks whose keys changed since last call """
+        rows = [row for row, track in enumerate(self.tracks)
+                if track.version != self.packed[row]]
+        if not rows:
+            return
+        longest = max(len(self.tracks[row].times) for row in rows)
+        bound = max(max(abs(self.tracks[row].times[0]),
+                        abs(self.tracks[row].times[-1])) for row in rows)
+        if longest > self.capacity or bound >= self.bound:
+            # grow geometrically so that appended keys rarely reallocate
+            self.capacity = max(longest, 2 * self.capacity)
+            self.bound = max(bound, 2 * self.bound, 1.)
+            count, capacity = len(self.tracks), self.capacity
+            self.times = np.zeros((count, capacity))
+            self.keys = np.zeros((count, capacity))
+            self.values = np.zeros((count, capacity, self.size))
+            self.count, self.last = np.zeros(count, int), np.ones(count)
+            # rows keys span [offset - bound, offset + bound]: no overlap
+            self.offset = self.rows * (2 * self.bound + 1)
+            rows = self.rows
+
+        for row in rows:
+            track = self.tracks[row]
+            times, count = track.times, len(track.times)
+            values = np.asarray(track.values, float).reshape(count, -1)
+            self.times[row, :count] = times
+            self.times[row, count:] = times[-1]  # padding keeps rows sorted
+            self.values[row, :count] = values  # scalars broadcast to size
+            self.count[row], self.last[row] = count, times[-1]
+            self.packed[row] = track.version
+        self.keys[rows] = self.times[rows] + self.offset[rows, None]
+
+    def interval(self, time):
+        """ like valueCycle for every track: surrounding values & fraction """
+        time = time % self.last
+        position = np.searchsorted(self.keys.ravel(), time + self.offset)
+        position -= self.rows * self.capacity
+        # bisect position 0 uses last key as previous one, as valueCycle does
+        previous = np.where(position > 0, position - 1, self.count - 1)
+        time0 = self.times[self.rows, previous]
+        time1 = self.times[self.rows, position]
+        return (self.values[self.rows, previous], self.values[self.rows, position],
+                (time - time0) / (time1 - time0))
+
+
+class KeyFrameAnimator:
+    """ Evaluates the TransformKeyFrames of all KeyFrameControlNodes of a
+        scene in one vectorized pass, writing local matrices directly """
+    def __init__(self, scene, indices):
+        self.scene, self.indices = scene, np.asarray(indices)
+        keyframes = [scene.nodes[index].keyframes for index in indices]
+        self.translation = KeyFrameTracks([k.translation for k in keyframes], 3)
+        self.rotation = KeyFrameTracks([k.rotation for k in keyframes], 4)
+        self.scale = KeyFrameTracks([k.scale for k in keyframes], 3)
+        self.circle = np.array([k.translation.interpolate is lerpCircle
+                                for k in keyframes])
+        self.matrices = np.zeros((len(keyframes), 4, 4), np.float32)
+        self.matrices[:, 3, 3] = 1
+
+    def animate(self, time, win=None):
+        """ local transforms of all animated nodes for given time """
+        for tracks in (self.translation, self.rotation, self.scale):
+            tracks.update()
+
+        value0, value1, fraction = self.translation.interval(time)
+        translation = value0 + fraction[:, None] * (value1 - value0)
+        if self.circle.any():
+            translation[self.circle] = batch_lerpCircle(
+                value0[self.circle], value1[self.circle], fraction[self.circle])
+        rotation = batch_quaternion_matrix(
+            batch_quaternion_slerp(*self.rotation.interval(time)))
+        value0, value1, fraction = self.scale.interval(time)
+        scale = value0 + fraction[:, None] * (value1 - value0)
+
+        # T @ R @ S assembled directly: scaled rotation columns, translation
+        self.matrices[:, :3, :3] = rotation * scale[:, None, :]
+        self.matrices[:, :3, 3] = translation
+
+        local, dirty = self.scene.local, self.scene.dirty
+        changed = (self.matrices != local[self.indices]).any(axis=(1, 2))
+        local[self.indices[changed]] = self.matrices[changed]
+        dirty[self.indices[changed]] = True
+
+
 class KeyFrameControlNode(Node):
     """ Place node with transform keys above a controlled subtree """
+    animator = KeyFrameAnimator  # subclasses overriding animate reset this
     def __init__(self, translate_keys, rotate_keys, scale_keys,
-                 name='', interpolate_translate = lerp, **kwargs):
+                 name='', interpolate_translate = lerp, window=None, **kwargs):
         super().__init__(name, **kwargs)
         self.keyframes = TransformKeyFrames(translate_keys,
                                             rotate_keys,
                                             scale_keys,
-                                            interpolate_translate)
+                                            interpolate_translate,
+                                            window)
         self.position = vec(0,0,0)
 
-    def draw(self, projection, view, model, win, **param):
-        """ When redraw requested, interpolate our node transform from keys """
-        self.transform = self.keyframes.valueCycle(glfw.get_time())
-        super().draw(projection, view, model, win, **param)
-
+    def animate(self, time, win=None):
+        """ interpolate our node transform from keys """
+        self.transform = self.keyframes.valueCycle(time)
 
     def get_Taille_rota(self):
         return self.keyframes.get_Taille_rota()
@@ -0,0 +1,108 @@
+"""
+Background asset loading pipeline.
+File parsing and texture baking run in a pool of worker threads, while the
+resulting OpenGL uploads are queued and drained by the GL thread, a few per
+frame within a time budget, so the window shows before assets are ready.
+"""
+# Python built-in modules
+import time                         # per frame upload budget
+from collections import deque       # queue of uploads waiting for GL thread
+from concurrent.futures import ThreadPoolExecutor
+
+from mesh import import_meshes, mesh_levels, TexturedMesh
+from vertex import textures
+from texbake import baker
+
+
+class AssetLoader:
+    """ Runs GL free loading work in worker threads, and the GL uploads it
+        produces on the thread calling process, i.e. the GL context owner """
+    def __init__(self, workers=4):
+        self.pool = ThreadPoolExecutor(workers)
+        self.jobs = {}          # job key => future, shared by same requests
+        self.pending = []       # (key, future, finish callback) not done yet
+        self.uploads = deque()  # zero argument GL upload steps, in order
+
+    def submit(self, key, work, finish):
+        """ run work() in a worker thread, at most once per key. Its result
+            is then given to finish, called on the GL thread, which returns
+            an iterable of upload steps to be run by process """
+        if key not in self.jobs:
+            self.jobs[key] = self.pool.submit(work)
+        self.pending.append((key, self.jobs[key], finish))
+
+    def process(self, budget=0.004):
+        """ run queued GL uploads until budget seconds are spent, at least
+            one per call. Returns True while some assets are still loading """
+        start = time.perf_counter()
+        still_pending = []
+        for key, future, finish in self.pending:
+            if not future.done():
+                still_pending.append((key, future, finish))
+            elif future.exception() is not None:
+                # a bad asset must not bring the render loop down: dropped,
+                # its placeholders if any staying in place
+                name = key[-1] if isinstance(key, tuple) else key
+                print('ERROR: unable to load %s (%s)' % (name,
+                                                         future.exception()))
+            else:
+                self.uploads.extend(finish(future.result()))
+        self.pending = still_pending
+        self.jobs = {key: job for key, job in self.jobs.items()
+                     if not job.done()}  # don't keep decoded data alive
+
+        while self.uploads:
+            self.uploads.popleft()()
+            if time.perf_counter() - start > budget:
+                break
+        return bool(self.pending or self.uploads)
+
+    def finish(self):
+        """ block until every submitted asset is loaded and uploaded """
+        while self.process(budget=float('inf')):
+            time.sleep(0.001)
+
+    def load_textured(self, file, node, placeholder=()):
+        """ asynchronous mesh.load_textured: the TexturedMeshes of file are
+            added to node as they get uploaded. Placeholder drawables are
+            shown in node meanwhile, and removed with the first mesh """
+        node.add(*placeholder)
+
+        def work():
+            """ parse meshes and bake or map their textures, GL free """
+            meshes = import_meshes(file)
+            images = {}
+            for mesh in meshes:
+                texture = mesh['texture']
+                if texture in images or texture is None or texture in textures:
+                    continue
+                try:
+                    images[texture] = baker.load(texture)
+                except OSError:
+                    pass  # missing or corrupt, reported by Texture on upload
+            return meshes, images
+
+        def upload(mesh, images):
+            """ create one mesh GL objects, replacing placeholders if any """
+            textured = TexturedMesh(mesh['texture'],
+                                    [mesh['vertices'], mesh.get('tex_uv'),
+                                     mesh['normals']],
+                                    mesh['faces'],
+                                    images.get(mesh['texture']),
+                                    mesh_levels(mesh))
+            for drawable in placeholder:
+                if drawable in node.children:
+                    node.children.remove(drawable)
+            node.add(textured)  # also recompiles scene for removals above
+
+        def finish(result):
+            meshes, images = result
+            size = sum((mesh['faces'].shape[0] for mesh in meshes))
+            print('Loaded %s\t(%d meshes, %d faces)' % (file, len(meshes), size))
+            return [lambda mesh=mesh: upload(mesh, images) for mesh in meshes]
+
+        self.submit(('textured', file), work, finish)
+        return node
+
+
+assets = AssetLoader()  # loader shared by the whole process
@@ -0,0 +1,151 @@
+"""
+Level of detail meshes.
+Coarser index buffers are built at import time by quadric error edge
+collapses onto existing vertices, so that all levels of a mesh share its
+vertex buffers. Each frame, a level is picked from the projected size of
+the mesh bounding sphere, with hysteresis to avoid popping back and forth.
+"""
+# External, non built-in modules
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+LOD_RATIOS = (1/4, 1/16, 1/64)  # face count of each coarser level
+LOD_MIN_FACES = 64              # no coarser level below this face count
+LOD_SIZES = (.3, .1, .03)       # screen sizes where coarser levels start
+
+
+def accumulate(indices, values, count):
+    """ sums of values rows by index, as count rows """
+    flat = values.reshape(len(values), -1)
+    sums = np.stack([np.bincount(indices, flat[:, i], count)
+                     for i in range(flat.shape[1])], axis=1)
+    return sums.reshape((count,) + values.shape[1:])
+
+
+def face_normals(vertices, faces):
+    """ non normalized normals of faces, of length twice their area """
+    corners = vertices[faces]
+    return np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+
+
+def decimate(vertices, faces, counts):
+    """ index arrays of faces decimated down to each of the decreasing face
+        counts, by collapsing edges onto one of their vertices. Collapses
+        are done by batches of independent edges, cheapest quadric error
+        first. Boundary vertices, e.g. along texture seams, never move """
+    vertices = np.asarray(vertices, np.float64)[:, :3]
+    faces = np.asarray(faces, np.int64)
+    count = len(vertices)
+
+    # error quadric of each vertex: sum of the squared distance to the planes
+    # of its faces, weighted by their area
+    normals = face_normals(vertices, faces)
+    areas = np.linalg.norm(normals, axis=1)
+    planes = np.zeros((len(faces), 4))
+    planes[:, :3] = normals / np.maximum(areas, 1e-30)[:, None]
+    planes[:, 3] = -np.einsum('ij,ij->i', planes[:, :3], vertices[faces[:, 0]])
+    plane_quadrics = areas[:, None, None] * planes[:, :, None] * planes[:, None]
+    quadrics = sum(accumulate(faces[:, k], plane_quadrics, count)
+                   for k in range(3))
+    points = np.hstack((vertices, np.ones((count, 1))))
+
+    levels = []
+    for target in counts:
+        while len(faces) > target:
+            # unique edges, those of a single face being on the boundary
+            edges = np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+            edges, uses = np.unique(edges, axis=0, return_counts=True)
+            locked = np.zeros(count, bool)
+            locked[edges[uses != 2].ravel()] = True
+
+            # cost of moving each end onto the other, cheapest kept per edge
+            quadric = quadrics[edges[:, 0]] + quadrics[edges[:, 1]]
+            costs = np.stack([np.einsum('ni,nij,nj->n', points[edges[:, 1 - k]],
+                                        quadric, points[edges[:, 1 - k]])
+                              for k in range(2)], axis=1)
+            costs[locked[edges]] = np.inf
+            side = np.argmin(costs, axis=1)
+            cost = costs[np.arange(len(edges)), side]
+            source = edges[np.arange(len(edges)), side]
+            target_vertex = edges[np.arange(len(edges)), 1 - side]
+
+            # each collapse removes about 2 faces: cheapest edges first,
+            # keeping those cheaper than any other edge of both their ends
+            order = np.argsort(cost)[:max((len(faces) - target) // 2, 1)]
+            order = order[np.isfinite(cost[order])]
+            rank = np.full(count, len(edges))
+            np.minimum.at(rank, source[order], np.arange(len(order)))
+            np.minimum.at(rank, target_vertex[order], np.arange(len(order)))
+            chosen = (rank[source[order]] == np.arange(len(order))) & \
+                     (rank[target_vertex[order]] == np.arange(len(order)))
+            source, target_vertex = source[order[chosen]], target_vertex[order[chosen]]
+
+            # cancel collapses flipping any of the faces they move
+            remap = np.arange(count)
+            while True:
+                remap[:] = np.arange(count)
+                remap[source] = target_vertex
+                moved = remap[faces]
+                kept = (moved[:, 0] != moved[:, 1]) & (moved[:, 1] != moved[:, 2]) \
+                    & (moved[:, 2] != moved[:, 0])
+                changed = kept & (moved != faces).any(axis=1)
+                flipped = np.einsum('ij,ij->i', normals[changed],
+                                    face_normals(vertices, moved[changed])) <= 0
+                flipped &= normals[changed].any(axis=1)  # not degenerate yet
+                if not flipped.any():
+                    break
+                rejected = np.zeros(count, bool)
+                rejected[faces[changed][flipped].ravel()] = True
+                keep = ~rejected[source]
+                source, target_vertex = source[keep], target_vertex[keep]
+            if not len(source):
+                break  # nothing left to collapse without damage
+
+            np.add.at(quadrics, target_vertex, quadrics[source])
+            faces = moved[kept]
+            normals = face_normals(vertices, faces)
+        levels.append(faces.astype(np.int32))
+    return levels
+
+
+def build_levels(vertices, faces, ratios=LOD_RATIOS, minimum=LOD_MIN_FACES):
+    """ coarser index arrays of a mesh, as many as its size allows """
+    counts = [int(len(faces) * ratio) for ratio in ratios]
+    counts = [count for count in counts if count >= minimum]
+    if not counts:
+        return []
+    levels = decimate(vertices, faces, counts)
+    # a level which couldn't get much smaller than the previous one is useless
+    sizes = [len(faces)] + [len(level) for level in levels]
+    return [level for i, level in enumerate(levels)
+            if len(level) < 0.75 * sizes[i]]
+
+
+def screen_size(sphere, model, view, projection):
+    """ radius of bounding sphere projected on screen, as a fraction of
+        half the viewport height """
+    center, radius = sphere
+    center = model[:3, :3] @ center + model[:3, 3]
+    radius *= np.linalg.norm(model[:3, :3], axis=0).max()
+    depth = -(view[2, :3] @ center + view[2, 3])
+    if depth <= radius:
+        return np.inf  # camera inside or near sphere
+    return radius * projection[1, 1] / depth
+
+
+class LevelSelector:
+    """ Level of detail choice of one mesh: coarser level i + 1 is used once
+        screen size falls below sizes[i], and finer level i again once it
+        gets back above sizes[i] raised by the hysteresis fraction """
+    def __init__(self, levels, sizes=LOD_SIZES, hysteresis=0.2):
+        self.sizes = sizes[:levels - 1]
+        self.hysteresis = hysteresis
+        self.level = 0
+
+    def select(self, size):
+        """ level to draw at given screen size """
+        while self.level < len(self.sizes) and size < self.sizes[self.level]:
+            self.level += 1
+        while self.level > 0 and \
+                size > self.sizes[self.level - 1] * (1 + self.hysteresis):
+            self.level -= 1
+        return self.level
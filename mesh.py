@@ -2,7 +2,12 @@ import pyassimp                     # 3D resource loader
 import pyassimp.errors              # Assimp error management + exceptions
 import os                           # os function, i.e. checking file status
 from shader import *
+from meshcache import mesh_cache
+from lod import build_levels, screen_size, LevelSelector
+from meshopt import optimize, tipsify
+from resolver import resolver
 from vertex import *
+from render import queue
 from itertools import cycle
 import glfw                 # lean window system wrapper for OpenGL
 from transform import normalized
@@ -12,22 +17,17 @@ class ColorMesh:
     def __init__(self, attributes, index=None):
         self.vertex_array = VertexArray(attributes, index)
 
-    def draw(self, projection, view, model, color_shader, **param):
+    def draw(self, projection, view, model, color_shader, normal_matrix=None,
+             invview=None, **param):
+        """ normal_matrix and invview, when computed by our node or viewer
+            for the whole frame, avoid inverting matrices per mesh """
+        if normal_matrix is None:
+            normal_matrix = np.transpose(np.linalg.inv(model[:3,:3]))
+        invview = np.linalg.inv(view) if invview is None else invview
 
-        names = ['view', 'projection', 'model', 'transinvmod',
-                 'invview']
-        loc = {n: GL.glGetUniformLocation(color_shader.glid, n) for n in names}
-        GL.glUseProgram(color_shader.glid)
-
-        GL.glUniformMatrix4fv(loc['view'], 1, True, view)
-        GL.glUniformMatrix4fv(loc['projection'], 1, True, projection)
-        GL.glUniformMatrix4fv(loc['model'], 1, True, model)
-        GL.glUniformMatrix3fv(loc['transinvmod'], 1, True,
-                              np.transpose(np.linalg.inv(model[:3,:3])))
-        GL.glUniformMatrix4fv(loc['invview'], 1, True, np.linalg.inv(view))
-
-        # draw triangle as GL_TRIANGLE vertex array, draw array call
-        self.vertex_array.execute(GL.GL_TRIANGLES)
+        queue.submit(color_shader, self.vertex_array, dict(
+            view=view, projection=projection, model=model,
+            transinvmod=normal_matrix, invview=invview))
 
 
 class SimpleTriangle(ColorMesh):
@@ -92,42 +92,61 @@ void main() {
 class PhongMesh:
 
     def __init__(self, attributes, index=None):
-        self.vertex_array = VertexArray(attributes, index)
+        # position & normal, normal packed in 4 bytes
+        self.vertex_array = VertexArray(attributes, index,
+                                        layout=('float', 'int2_10_10_10'))
 
     def draw(self, projection, view, model, color_shader, color
             =(1.,0.,0.), light = (0.,1.,0.),Ka=(0.2,0.,0.),
-            Ks=(0.3,0.3,0.3), s=0.01, **param):
-        names = ['view', 'projection', 'model', 'normal','color',
-        'lightDirection', 'Ka', 'Ks', 's', 'transinvmod',
-                 'invview']
-        loc = {n: GL.glGetUniformLocation(color_shader.glid, n) for n in names}
-        GL.glUseProgram(color_shader.glid)
-
-        GL.glUniformMatrix4fv(loc['view'], 1, True, view)
-        GL.glUniformMatrix4fv(loc['projection'], 1, True, projection)
-        GL.glUniformMatrix4fv(loc['model'], 1, True, model)
-        GL.glUniformMatrix3fv(loc['transinvmod'], 1, True, 
-                              np.transpose(np.linalg.inv(model[:3,:3])))
-        GL.glUniformMatrix4fv(loc['invview'], 1, True,
-                              np.linalg.inv(view))
-        GL.glUniform3fv(loc['color'], 1, color)
-        GL.glUniform3fv(loc['lightDirection'], 1, light)
-        GL.glUniform3fv(loc['Ka'], 1, Ka)
-        GL.glUniform3fv(loc['Ks'], 1, Ks)
-        GL.glUniform1fv(loc['s'], 1, s)
-
-        # draw triangle as GL_TRIANGLE vertex array, draw array call
-        self.vertex_array.execute(GL.GL_TRIANGLES)
-
+            Ks=(0.3,0.3,0.3), s=0.01, normal_matrix=None, invview=None,
+            **param):
+        if normal_matrix is None:
+            normal_matrix = np.transpose(np.linalg.inv(model[:3,:3]))
+        invview = np.linalg.inv(view) if invview is None else invview
+
+        queue.submit(color_shader, self.vertex_array, dict(
+            view=view, projection=projection, model=model,
+            transinvmod=normal_matrix, invview=invview,
+            color=color, lightDirection=light, Ka=Ka, Ks=Ks, s=s))
+
+
+
+class ProxySphere(PhongMesh):
+    """ Cheap stand in for a model still loading: low poly grey sphere of
+        about the model radius """
+
+    def __init__(self, radius=1., slices=12, stacks=6):
+        theta = np.linspace(0, np.pi, stacks + 1)[:, None]
+        phi = np.linspace(0, 2 * np.pi, slices + 1)[None, :]
+        normal = np.stack(np.broadcast_arrays(np.sin(theta) * np.cos(phi),
+                                              np.cos(theta),
+                                              np.sin(theta) * np.sin(phi)),
+                          axis=-1).reshape(-1, 3).astype(np.float32)
+        grid = np.arange((stacks + 1) * (slices + 1)).reshape(stacks + 1, -1)
+        a, b = grid[:-1, :-1].ravel(), grid[:-1, 1:].ravel()
+        c, d = grid[1:, :-1].ravel(), grid[1:, 1:].ravel()
+        index = np.hstack([np.stack([a, b, c], 1), np.stack([b, d, c], 1)])
+        super().__init__([radius * normal, normal], index.reshape(-1, 3))
+
+    def draw(self, projection, view, model, win=None, **param):
+        """ drawn by nodes, which give their window as fourth argument """
+        param.update(color=(.5, .5, .5), Ka=(.1, .1, .1), Ks=(0., 0., 0.))
+        super().draw(projection, view, model, **param)
 
 
 class TexturedMesh:
     """ Simple first textured object """
 
-    def __init__(self, texture, attribute, index=None):
-        # feel free to move this up in the viewer as per other practicals
-        self.shader = Shader(TEXTURE_VERT, TEXTURE_FRAG)
-        self.vertex_array = VertexArray(attribute, index)
+    def __init__(self, texture, attribute, index=None, image=None, levels=()):
+        """ image optionally holds the already baked texture file, levels
+            the coarser index arrays drawn when the mesh looks small """
+        # program shared by all textured meshes, compiled once per process
+        self.shader = shaders.acquire(TEXTURE_VERT, TEXTURE_FRAG)
+        # interleaved position, compact texture coordinates & normal
+        layout = ('float', texcoord_format(attribute[1]), 'int2_10_10_10')
+        self.vertex_array = VertexArray(attribute, index, levels=levels,
+                                        layout=layout)
+        self.lod = LevelSelector(len(self.vertex_array.levels))
 
 
         # interactive toggles
@@ -138,60 +157,62 @@ class TexturedMesh:
                              (GL.GL_LINEAR, GL.GL_LINEAR_MIPMAP_LINEAR)])
         self.wrap_mode, self.filter_mode = next(self.wrap), next(self.filter)
 
-        # setup texture and upload it to GPU
+        # setup texture and upload it to GPU, shared with same file users
+        # wrap & filter modes live in a sampler, toggled without re-upload
         self.file = texture
-        self.texture = Texture(self.file, self.wrap_mode, *self.filter_mode)
+        self.texture = textures.acquire(self.file, image=image)
+        self.sampler = get_sampler(self.wrap_mode, *self.filter_mode)
 
     def draw(self, projection, view, model, win=None, **_kwargs):
         
 
-        # some interactive elements
-        if glfw.get_key(win, glfw.KEY_E) == glfw.PRESS:
+        # some interactive elements, none without window when headless
+        if win is not None and glfw.get_key(win, glfw.KEY_E) == glfw.PRESS:
             self.wrap_mode = next(self.wrap)
-            self.texture = Texture(self.file, self.wrap_mode, *self.filter_mode)
+            self.sampler = get_sampler(self.wrap_mode, *self.filter_mode)
 
-        if glfw.get_key(win, glfw.KEY_R) == glfw.PRESS:
+        if win is not None and glfw.get_key(win, glfw.KEY_R) == glfw.PRESS:
             self.filter_mode = next(self.filter)
-            self.texture = Texture(self.file, self.wrap_mode, *self.filter_mode)
-        
-        GL.glUseProgram(self.shader.glid)
-        
+            self.sampler = get_sampler(self.wrap_mode, *self.filter_mode)
+
         light_direction = (0,0,0)
 
         if('light' in _kwargs and 'position' in _kwargs):
             light_direction = normalized(_kwargs['light']-_kwargs['position'])
         
 
-        # projection geometry
-        loc = GL.glGetUniformLocation(self.shader.glid, 'modelviewprojection')
-        GL.glUniformMatrix4fv(loc, 1, True, projection @ view @ model)
+        # projection geometry, using matrices shared by the frame or node
+        viewprojection = _kwargs.get('viewprojection')
+        if viewprojection is None:
+            viewprojection = projection @ view
+        normal_matrix = _kwargs.get('normal_matrix')
+        if normal_matrix is None:
+            normal_matrix = np.transpose(np.linalg.inv(model[:3,:3]))
 
-        loc2 = GL.glGetUniformLocation(self.shader.glid,
-                                       'light_direction')
-        GL.glUniform3fv(loc2, 1, light_direction)
-        loc3 = GL.glGetUniformLocation(self.shader.glid,
-                                       'transinvmod')
-        GL.glUniformMatrix3fv(loc3, 1, True, 
-                              np.transpose(np.linalg.inv(model[:3,:3])))
-        # texture access setups
-        loc = GL.glGetUniformLocation(self.shader.glid, 'diffuseMap')
-        GL.glActiveTexture(GL.GL_TEXTURE0)
+        # level of detail from the size the mesh is seen at
+        level = 0
+        if len(self.vertex_array.levels) > 1:
+            level = self.lod.select(screen_size(self.vertex_array.sphere,
+                                                model, view, projection))
 
-        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture.glid)
-        GL.glUniform1i(loc, 0)
-        self.vertex_array.execute(GL.GL_TRIANGLES)
+        # texture on unit 0, through our sampler
+        queue.submit(self.shader, self.vertex_array, dict(
+            modelviewprojection=viewprojection @ model,
+            light_direction=light_direction,
+            transinvmod=normal_matrix, diffuseMap=0),
+            [(GL.GL_TEXTURE_2D, self.texture, self.sampler)], level=level)
 
-        # leave clean state for easier debugging
-        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
-        GL.glUseProgram(0)
+    def __del__(self):  # give back our references to shared GPU resources
+        shaders.release(self.shader)
+        textures.release(self.texture)
 
 
 class TexturedPlane:
     """ Simple first textured object """
 
     def __init__(self, file):
-        # feel free to move this up in the viewer as per other practicals
-        self.shader = Shader(TEXTURE_VERT, TEXTURE_FRAG)
+        # program shared by all textured meshes, compiled once per process
+        self.shader = shaders.acquire(TEXTURE_VERT, TEXTURE_FRAG)
 
         # triangle and face buffers
         vertices = 100 * np.array(((-1, -1, 0), (1, -1, 0), (1, 1, 0), (-1, 1, 0)), np.float32)
@@ -207,97 +228,134 @@ class TexturedPlane:
         self.wrap_mode, self.filter_mode = next(self.wrap), next(self.filter)
         self.file = file
 
-        # setup texture and upload it to GPU
-        self.texture = Texture(file, self.wrap_mode, *self.filter_mode)
+        # setup texture and upload it to GPU, shared with same file users
+        # wrap & filter modes live in a sampler, toggled without re-upload
+        self.texture = textures.acquire(file)
+        self.sampler = get_sampler(self.wrap_mode, *self.filter_mode)
 
     def draw(self, projection, view, model, win=None, **_kwargs):
 
-        # some interactive elements
-        if glfw.get_key(win, glfw.KEY_E) == glfw.PRESS:
+        # some interactive elements, none without window when headless
+        if win is not None and glfw.get_key(win, glfw.KEY_E) == glfw.PRESS:
             self.wrap_mode = next(self.wrap)
-            self.texture = Texture(self.file, self.wrap_mode, *self.filter_mode)
+            self.sampler = get_sampler(self.wrap_mode, *self.filter_mode)
 
-        if glfw.get_key(win, glfw.KEY_R) == glfw.PRESS:
+        if win is not None and glfw.get_key(win, glfw.KEY_R) == glfw.PRESS:
             self.filter_mode = next(self.filter)
-            self.texture = Texture(self.file, self.wrap_mode, *self.filter_mode)
-
-        GL.glUseProgram(self.shader.glid)
-
-        # projection geometry
-        loc = GL.glGetUniformLocation(self.shader.glid, 'modelviewprojection')
-        GL.glUniformMatrix4fv(loc, 1, True, projection @ view @ model)
-
-        # texture access setups
-        loc = GL.glGetUniformLocation(self.shader.glid, 'diffuseMap')
-        GL.glActiveTexture(GL.GL_TEXTURE0)
-        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture.glid)
-        GL.glUniform1i(loc, 0)
-        self.vertex_array.execute(GL.GL_TRIANGLES)
-
-        # leave clean state for easier debugging
-        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
-        GL.glUseProgram(0)
-
+            self.sampler = get_sampler(self.wrap_mode, *self.filter_mode)
 
-def load(file):
-    """ load resources from file using pyassimp, return list of ColorMesh """
-    try:
-        option = pyassimp.postprocess.aiProcessPreset_TargetRealtime_MaxQuality
-        scene = pyassimp.load(file, option)
-    except pyassimp.errors.AssimpError:
-        print('ERROR: pyassimp unable to load', file)
-        return []  # error reading => return empty list
+        # projection geometry, texture on unit 0 through our sampler
+        queue.submit(self.shader, self.vertex_array, dict(
+            modelviewprojection=projection @ view @ model, diffuseMap=0),
+            [(GL.GL_TEXTURE_2D, self.texture, self.sampler)])
 
-    meshes = [PhongMesh([m.vertices, m.normals], m.faces) for m in scene.meshes]
-    size = sum((mesh.faces.shape[0] for mesh in scene.meshes))
-    print('Loaded %s\t(%d meshes, %d faces)' % (file, len(scene.meshes), size))
-
-    pyassimp.release(scene)
-    return meshes
+    def __del__(self):  # give back our references to shared GPU resources
+        shaders.release(self.shader)
+        textures.release(self.texture)
 
 
-
-def load_textured(file):
-    """ load resources using pyassimp, return list of TexturedMeshes """
+def assimp_meshes(file, option):
+    """ import file with pyassimp, return its mesh arrays as list of dicts,
+        texture paths relative to file's folder, None if import failed """
     try:
-        option = pyassimp.postprocess.aiProcessPreset_TargetRealtime_MaxQuality
         scene = pyassimp.load(file, option)
     except pyassimp.errors.AssimpError:
         print('ERROR: pyassimp unable to load', file)
-        return []  # error reading => return empty list
+        return None
 
     # Note: embedded textures not supported at the moment
     path = os.path.dirname(file)
     path = os.path.join('.', '') if path == '' else path
     for mat in scene.materials:
         mat.tokens = dict(reversed(list(mat.properties.items())))
+        mat.texture = None
         if 'file' in mat.tokens:  # texture file token
-            tname = mat.tokens['file'].split('/')[-1].split('\\')[-1]
+            tname = mat.tokens['file']
             # search texture in file's whole subdir since path often screwed up
-            tname = [os.path.join(d[0], f) for d in os.walk(path) for f in d[2]
-                     if tname.startswith(f) or f.startswith(tname)]
-            if tname:
-                mat.texture = tname[0]
+            found = resolver.find(tname, path)
+            if found:
+                mat.texture = os.path.relpath(found, path)
             else:
                 print('Failed to find texture:', tname)
 
-    # prepare textured mesh
     meshes = []
     for mesh in scene.meshes:
-        texture = scene.materials[mesh.materialindex].texture
-
         # tex coords in raster order: compute 1 - y to follow OpenGL convention
         tex_uv = ((0, 1) + mesh.texturecoords[0][:, :2] * (1, -1)
                   if mesh.texturecoords.size else None)
+        arrays = dict(vertices=mesh.vertices, normals=mesh.normals,
+                      tex_uv=tex_uv, faces=mesh.faces)
+        meshes.append({name: np.asarray(value, np.int32 if name == 'faces'
+                                        else np.float32)
+                       for name, value in arrays.items() if value is not None})
+        meshes[-1]['texture'] = scene.materials[mesh.materialindex].texture
 
-        normal = mesh.normals
-        # create the textured mesh object from texture, attributes, and indices
-        meshes.append(TexturedMesh(texture, [mesh.vertices,
-                                             tex_uv, normal],
-                                   mesh.faces))
+    pyassimp.release(scene)
+    return meshes
 
-    size = sum((mesh.faces.shape[0] for mesh in scene.meshes))
-    print('Loaded %s\t(%d meshes, %d faces)' % (file, len(scene.meshes), size))
 
-    pyassimp.release(scene)
+def import_meshes(file):
+    """ post-processed mesh arrays of file as list of dicts with vertices,
+        normals, tex_uv, faces and texture path entries. Read from the mesh
+        cache when up to date, else imported with pyassimp and cached """
+    option = pyassimp.postprocess.aiProcessPreset_TargetRealtime_MaxQuality
+    meshes = mesh_cache.load(file, option)
+    if meshes is None:
+        meshes = assimp_meshes(file, option)
+        if meshes is None:
+            return []  # error reading => return empty list
+        for i, mesh in enumerate(meshes):
+            # welded & cache ordered, coarser levels stored one after the other
+            meshes[i], before, after = optimize(mesh)
+            print('Optimized %s mesh %d\t(%d -> %d vertices, ACMR %.2f -> %.2f)'
+                  % (file, i, len(mesh['vertices']),
+                     len(meshes[i]['vertices']), before, after))
+            mesh = meshes[i]
+            levels = [tipsify(level, len(mesh['vertices']))
+                      for level in build_levels(mesh['vertices'], mesh['faces'])]
+            mesh['lod_sizes'] = [len(level) for level in levels]
+            mesh['lod_faces'] = np.concatenate(levels) if levels \
+                else np.zeros((0, 3), np.int32)
+        mesh_cache.store(file, option, meshes)
+
+    # texture paths are stored relative to the imported file's folder
+    for mesh in meshes:
+        if mesh['texture'] is not None:
+            mesh['texture'] = os.path.join(os.path.dirname(file),
+                                           mesh['texture'])
+    return meshes
+
+
+def mesh_levels(mesh):
+    """ coarser index arrays of an imported mesh, finest first """
+    ends = np.cumsum(mesh.get('lod_sizes', []), dtype=int)
+    return [mesh['lod_faces'][end - size:end]
+            for end, size in zip(ends, mesh.get('lod_sizes', []))]
+
+
+def load(file):
+    """ load resources from file using pyassimp, return list of ColorMesh """
+    scene_meshes = import_meshes(file)
+    meshes = [PhongMesh([m['vertices'], m['normals']], m['faces'])
+              for m in scene_meshes]
+    size = sum((mesh['faces'].shape[0] for mesh in scene_meshes))
+    print('Loaded %s\t(%d meshes, %d faces)' % (file, len(meshes), size))
+    return meshes
+
+
+def load_textured(file):
+    """ load resources using pyassimp, return list of TexturedMeshes """
+    scene_meshes = import_meshes(file)
+
+    # prepare textured mesh
+    meshes = []
+    for mesh in scene_meshes:
+        # create the textured mesh object from texture, attributes, and indices
+        meshes.append(TexturedMesh(mesh['texture'],
+                                   [mesh['vertices'], mesh.get('tex_uv'),
+                                    mesh['normals']],
+                                   mesh['faces'], levels=mesh_levels(mesh)))
+
+    size = sum((mesh['faces'].shape[0] for mesh in scene_meshes))
+    print('Loaded %s\t(%d meshes, %d faces)' % (file, len(meshes), size))
     return meshes
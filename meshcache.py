@@ -0,0 +1,92 @@
+"""
+On disk cache of post-processed pyassimp imports.
+Each imported file gets a cache entry directory holding an index.json
+header and one raw .npy buffer per mesh array, memory mapped back on load.
+"""
+# Python built-in modules
+import hashlib                      # entry names & source content checks
+import json                         # entry index header
+import os                           # os function, i.e. checking file status
+
+# External, non built-in modules
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+CACHE_VERSION = 3   # bump whenever the stored layout or import steps change
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '.meshcache')
+
+
+def file_hash(file):
+    """ sha1 hex digest of file content """
+    digest = hashlib.sha1()
+    with open(file, 'rb') as source:
+        for block in iter(lambda: source.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class MeshCache:
+    """ Stores post-processed mesh arrays of imported files, invalidated by
+        source modification time, size, content hash and import flags """
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+
+    def entry(self, file, flags):
+        """ cache entry directory for file imported with given flags """
+        key = '%s|%d|%d' % (os.path.realpath(file), flags, CACHE_VERSION)
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode()).hexdigest())
+
+    def load(self, file, flags):
+        """ list of mesh dicts cached for file, None if missing or stale """
+        entry = self.entry(file, flags)
+        try:
+            with open(os.path.join(entry, 'index.json')) as index_file:
+                index = json.load(index_file)
+            stat = os.stat(file)
+            if (index['mtime'], index['size']) != (stat.st_mtime, stat.st_size):
+                # touched but maybe unchanged: only content hash can tell
+                if index['hash'] != file_hash(file):
+                    return None
+                index['mtime'], index['size'] = stat.st_mtime, stat.st_size
+                with open(os.path.join(entry, 'index.json'), 'w') as index_file:
+                    json.dump(index, index_file)
+            meshes = []
+            for i, mesh in enumerate(index['meshes']):
+                mesh = dict(mesh)
+                for name in mesh.pop('arrays'):
+                    path = os.path.join(entry, '%d_%s.npy' % (i, name))
+                    mesh[name] = np.load(path, mmap_mode='r')
+                meshes.append(mesh)
+        except (OSError, ValueError, KeyError):
+            return None
+        return meshes
+
+    def store(self, file, flags, meshes):
+        """ write mesh dicts of file to cache, arrays as raw .npy buffers """
+        entry = self.entry(file, flags)
+        stat = os.stat(file)
+        index = dict(mtime=stat.st_mtime, size=stat.st_size, flags=flags,
+                     hash=file_hash(file), meshes=[])
+        try:
+            os.makedirs(entry, exist_ok=True)
+            if os.path.exists(os.path.join(entry, 'index.json')):
+                os.remove(os.path.join(entry, 'index.json'))
+            for i, mesh in enumerate(meshes):
+                header = dict(arrays=[])
+                for name, value in mesh.items():
+                    if isinstance(value, np.ndarray):
+                        np.save(os.path.join(entry, '%d_%s.npy' % (i, name)),
+                                value)
+                        header['arrays'].append(name)
+                    else:
+                        header[name] = value
+                index['meshes'].append(header)
+            # index is written last: its presence marks a complete entry
+            with open(os.path.join(entry, 'index.json'), 'w') as index_file:
+                json.dump(index, index_file)
+        except OSError as error:
+            print('WARNING: unable to cache %s (%s)' % (file, error))
+
+
+mesh_cache = MeshCache()  # cache shared by the whole process
@@ -1,30 +1,115 @@
 from transform import Trackball, identity, translate, rotate
 from transform import scale, lerp, vec
+from clock import clock
+from profiler import profiler
+from render import queue
 import glfw
+import numpy as np
 
 class Node:
     """ Scene graph transform and parameter broadcast node """
+    animator = None  # class animating all such nodes of a scene at once
     def __init__(self, name='', children=(), transform=identity(), **param):
-        self.transform, self.param, self.name = transform, param, name
+        self._transform, self.param, self.name = transform, param, name
         self.children = list(iter(children))
+        # world & normal matrices cache, valid while parent world is the same
+        # object and our transform did not change
+        self.parent_world, self.world, self.normal_matrix = None, None, None
+        self.scene, self.index = None, None  # set once compiled in a Scene
         pos = self.transform[:4,:4]@vec(0,0,0,1)
         self.position = pos[:3]
         #self.lightList = Light_list()
 
+    @property
+    def transform(self):
+        """ local transform of this node relative to its parent """
+        if self.scene is not None:
+            return self.scene.local[self.index]
+        return self._transform
+
+    @transform.setter
+    def transform(self, transform):
+        if self.scene is not None:
+            self.scene.set_local(self.index, transform)
+        elif not np.array_equal(transform, self._transform):
+            self._transform = transform
+            self.parent_world = None  # invalidate world matrices cache
+
+    def animate(self, time, win=None):
+        """ update local transform for given time, before world matrices are
+            computed for the frame. Nothing to do for a static node """
+        pass
+
+    def update(self, time, win=None):
+        """ advance simulation state to given time, once per clock fixed
+            step, world matrices being those of this time """
+        pass
+
+    def get_model(self):
+        """ world matrix of our parent, as last computed """
+        if self.scene is not None:
+            parent = self.scene.parent[self.index]
+            return self.scene.world[parent] if parent >= 0 else self.scene.model
+        return self.parent_world
+
+    def update_world(self, model):
+        """ world matrix for parent world model, recomputed only if model or
+            transform changed since last call. The returned matrix object is
+            kept as is while valid, so children can detect change by identity """
+        if model is not self.parent_world:
+            self.parent_world = model
+            self.world = model @ self._transform
+            self.normal_matrix = None  # computed on demand by draw
+            self.position = self.world[:3, 3]
+        return self.world
+
     def add(self, *drawables):
         """ Add drawables to this node, simply updating children list """
         #self.lightList.add()
         self.children.extend(drawables)
+        if self.scene is not None:
+            self.scene.stale = True  # recompiled before next frame
 
     def draw(self, projection, view, model, win, **param):
         """ Recursive draw, passing down named parameters & model matrix. """
-        # merge named parameters given at initialization with those given here
-        param = dict(param, **self.param)
-        model2 = model @ self.transform
-        pos = model2@vec(0,0,0,1)
-        self.position = pos[:3]
+        # merge named parameters given at initialization with those given
+        # here, param being already our own copy as a ** argument
+        if self.param:
+            param.update(self.param)
+
+        shown = True
+        if self.scene is not None:  # matrices computed by scene for frame
+            if not self.scene.visible[self.index]:
+                return  # whole subtree out of view
+            shown = self.scene.shown[self.index]
+            model2 = self.scene.world[self.index]
+            param['normal_matrix'] = self.scene.normal[self.index]
+        else:
+            self.animate(clock.get_render_time(), win)
+            model2 = self.update_world(model)
+
+            # normal matrix only needed, inverted once, for mesh children
+            if self.normal_matrix is None and \
+                    not all(isinstance(child, Node) for child in self.children):
+                self.normal_matrix = np.transpose(np.linalg.inv(model2[:3,:3]))
+            param['normal_matrix'] = self.normal_matrix
+
+        if not profiler.detailed:
+            self.draw_children(shown, projection, view, model2, win, **param)
+            return
+        # per node timing, children included, and label of the render items
+        # submitted by our meshes for per item timing at flush
+        outer = queue.label
+        queue.label = 'node %s' % (self.name or type(self).__name__)
+        with profiler.scope(queue.label):
+            self.draw_children(shown, projection, view, model2, win, **param)
+        queue.label = outer
+
+    def draw_children(self, shown, projection, view, model, win, **param):
+        """ draw child nodes, and own meshes if shown """
         for child in self.children:
-            child.draw(projection, view, model2, win, **param)
+            if shown or isinstance(child, Node):
+                child.draw(projection, view, model, win, **param)
 
     def is_Planete(self):
         return False
@@ -39,12 +124,187 @@ class RotationControlNode(Node):
         self.angle, self.axis = angle, axis
         self.key_up, self.key_down = key_up, key_down
 
-    def draw(self, projection, view, model, win=None, **param):
-        assert win is not None
+    def update(self, time, win=None):
+        """ rotate while control keys are pressed, still when headless """
+        if win is None:
+            return
         self.angle += 0.2 * int(glfw.get_key(win, self.key_up) == glfw.PRESS)
         self.angle -= 0.2 * int(glfw.get_key(win, self.key_down) == glfw.PRESS)
+
+    def animate(self, time, win=None):
         #model = model @ param.get('transf', identity())
         self.transform = rotate(self.axis, self.angle)
 
-        # call Node's draw method to pursue the hierarchical tree calling
-        super().draw(projection, view, model, win=win, **param)
+
+# ------------  Compiled scene graph ------------------------------------------
+class Scene:
+    """ Flattened Node tree: nodes in breadth first order with parent
+        indices, stacked local and world matrices. World matrices are
+        computed level by level with batched products, only for nodes whose
+        local transform changed since last frame and their descendants """
+    def __init__(self, root):
+        self.root, self.model = root, identity()
+        self.compile()
+
+    def compile(self):
+        """ flatten root tree, keeping current local transforms """
+        nodes, parents, depths = [self.root], [-1], [0]
+        for i, node in enumerate(nodes):  # nodes grows while iterated
+            for child in node.children:
+                if isinstance(child, Node):
+                    nodes.append(child)
+                    parents.append(i)
+                    depths.append(depths[i] + 1)
+
+        self.local = np.array([node.transform for node in nodes], np.float32)
+        self.world = np.empty_like(self.local)
+        self.normal = np.empty((len(nodes), 3, 3), np.float32)
+        self.nodes, self.parent = nodes, np.array(parents)
+        depths = np.array(depths)
+        self.levels = [np.flatnonzero(depths == depth)
+                       for depth in range(depths.max() + 1)]
+        # normal matrices only needed for nodes drawing meshes
+        self.meshes = np.array([not all(isinstance(child, Node)
+                                        for child in node.children)
+                                for node in nodes])
+        self.dirty = np.ones(len(nodes), bool)
+        self.stale = False
+
+        # bounding box of the meshes of each node, in node frame, as center
+        # & half extent. Drawables without box are never culled
+        lower = np.full((len(nodes), 3), np.inf, np.float32)
+        upper = np.full((len(nodes), 3), -np.inf, np.float32)
+        self.unbounded = np.zeros(len(nodes), bool)
+        for index, node in enumerate(nodes):
+            for child in node.children:
+                box = getattr(getattr(child, 'vertex_array', None), 'box', None)
+                if box is not None:
+                    lower[index] = np.minimum(lower[index], box[0])
+                    upper[index] = np.maximum(upper[index], box[1])
+                elif not isinstance(child, Node):
+                    self.unbounded[index] = True
+        self.empty = ~self.unbounded & np.isinf(lower).any(axis=1)
+        bounded = ~self.unbounded & ~self.empty
+        self.center = np.zeros((len(nodes), 3), np.float32)
+        self.extent = np.zeros((len(nodes), 3), np.float32)
+        self.center[bounded] = (lower[bounded] + upper[bounded]) / 2
+        self.extent[bounded] = (upper[bounded] - lower[bounded]) / 2
+        # world boxes of own meshes, and of whole subtrees
+        self.lower, self.upper = lower, upper
+        self.lower[self.unbounded], self.upper[self.unbounded] = -np.inf, np.inf
+        self.tree_lower, self.tree_upper = lower.copy(), upper.copy()
+        self.visible = np.ones(len(nodes), bool)  # subtree in view
+        self.shown = np.ones(len(nodes), bool)    # own meshes in view
+
+        # nodes animated in batch by their class animator, others one by one
+        batches = {}
+        for index, node in enumerate(nodes):
+            if node.animator is not None:
+                batches.setdefault(node.animator, []).append(index)
+        self.animators = [animator(self, indices)
+                          for animator, indices in batches.items()]
+        self.animated = [node for node in nodes if node.animator is None
+                         and type(node).animate is not Node.animate]
+        self.updated = [node for node in nodes
+                        if type(node).update is not Node.update]
+
+        for index, node in enumerate(nodes):
+            node.scene, node.index = self, index
+            node.position = self.world[index, :3, 3]  # view, always current
+
+    def set_local(self, index, transform):
+        """ local transform of node index, flagged dirty if it changed """
+        if not np.array_equal(transform, self.local[index]):
+            self.local[index] = transform
+            self.dirty[index] = True
+
+    def animate(self, time, win=None):
+        """ let every node update its local transform for given time """
+        for animator in self.animators:
+            animator.animate(time, win)
+        for node in self.animated:
+            node.animate(time, win)
+
+    def propagate(self, model):
+        """ world & normal matrices of dirty nodes and their descendants """
+        dirty = self.dirty
+        if model is not self.model:  # new root matrix: whole tree moves
+            self.model = model
+            dirty[:] = True
+        for depth, level in enumerate(self.levels):
+            if depth:
+                dirty[level] |= dirty[self.parent[level]]
+            changed = level[dirty[level]]
+            if changed.size:
+                parent = self.world[self.parent[changed]] if depth else model
+                self.world[changed] = parent @ self.local[changed]
+
+        changed = np.flatnonzero(dirty & self.meshes)
+        if changed.size:
+            inverse = np.linalg.inv(self.world[changed, :3, :3])
+            self.normal[changed] = inverse.transpose(0, 2, 1)
+
+        if dirty.any():
+            self.bound(np.flatnonzero(dirty & ~self.empty & ~self.unbounded))
+        dirty[:] = False
+
+    def bound(self, changed):
+        """ world boxes of changed nodes meshes, then of all subtrees """
+        rotation = self.world[changed, :3, :3]
+        center = np.einsum('nij,nj->ni', rotation, self.center[changed]) \
+            + self.world[changed, :3, 3]
+        extent = np.einsum('nij,nj->ni', np.abs(rotation), self.extent[changed])
+        self.lower[changed], self.upper[changed] = center - extent, center + extent
+
+        # subtree boxes merged into parents, deepest level first
+        self.tree_lower[:], self.tree_upper[:] = self.lower, self.upper
+        for level in reversed(self.levels[1:]):
+            np.minimum.at(self.tree_lower, self.parent[level],
+                          self.tree_lower[level])
+            np.maximum.at(self.tree_upper, self.parent[level],
+                          self.tree_upper[level])
+
+    @staticmethod
+    def inside(planes, lower, upper):
+        """ which boxes are at least partly on the inner side of all planes.
+            Infinite boxes are always inside, empty ones never """
+        finite = np.isfinite(lower).all(axis=1) & np.isfinite(upper).all(axis=1)
+        empty = (lower > upper).any(axis=1)  # before infinite ones are zeroed
+        lower = np.where(finite[:, None], lower, 0)
+        upper = np.where(finite[:, None], upper, 0)
+        # box corner farthest along each plane normal
+        corner = np.where(planes[None, :, :3] > 0, upper[:, None], lower[:, None])
+        distance = np.einsum('npk,pk->np', corner, planes[:, :3]) + planes[:, 3]
+        return finite & (distance >= 0).all(axis=1) | ~finite & ~empty
+
+    def cull(self, viewprojection):
+        """ flag nodes whose subtree or own meshes are in view frustum """
+        m = viewprojection
+        planes = np.array([m[3] + m[0], m[3] - m[0], m[3] + m[1],
+                           m[3] - m[1], m[3] + m[2], m[3] - m[2]])
+        self.visible = self.inside(planes, self.tree_lower, self.tree_upper)
+        self.shown = self.inside(planes, self.lower, self.upper)
+        profiler.count('culled nodes', np.count_nonzero(~self.shown & ~self.empty))
+
+    def update(self, time, win=None):
+        """ simulation step: nodes updated with world matrices of time """
+        if self.stale:
+            self.compile()
+        self.animate(time, win)
+        self.propagate(self.model)
+        for node in self.updated:
+            node.update(time, win)
+
+    def draw(self, projection, view, model, win=None, **param):
+        """ animate at render time, update changed world matrices, then
+            draw the tree """
+        if self.stale:
+            self.compile()
+        with profiler.scope('animate'):
+            self.animate(clock.get_render_time(), win)
+        with profiler.scope('propagate'):
+            self.propagate(model)
+            viewprojection = param.get('viewprojection')
+            self.cull(projection @ view if viewprojection is None
+                      else viewprojection)
+        self.root.draw(projection, view, model, win, **param)
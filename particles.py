@@ -1,5 +1,3 @@
-import random
-
 # External, non built-in modules
 import OpenGL.GL as GL              # standard Python OpenGL wrapper
 import glfw                         # lean window system wrapper for OpenGL
@@ -9,119 +7,92 @@ import pyassimp.errors              # assimp error management + exceptions
 from PIL import Image               # load images for textures
 
 from vertex import *
+from render import queue, TRANSPARENT, ADDITIVE
 
 
 # -----------------------------------------------------------------------------
-class Particle:
-    """ particle object """
-
-    def __init__(self, position=np.array((0,0,0), 'f'),
-                 velocity=np.array((0,1,0), 'f'),
-                 color=np.array((1,1,1,1), 'f'), life=20.1):
-
-        self.position = position
-        self.velocity = velocity
-        self.color = color
-        self.life = life
+class ParticleArrays:
+    """ particle store: one row per particle slot in contiguous arrays """
+
+    def __init__(self, amount, life=0.0):
+        self.position = np.zeros((amount, 3), 'f')
+        self.velocity = np.tile(np.array((0,1,0), 'f'), (amount, 1))
+        self.color = np.ones((amount, 4), 'f')
+        self.life = np.full(amount, life, 'f')  # slot is free when life <= 0
+
+    def alive(self):
+        """ boolean mask of the slots holding a living particle """
+        return self.life > 0.0
+
+    def free_slots(self, count=None):
+        """ indices of (at most count) dead slots, ready to be respawned """
+        return np.flatnonzero(self.life <= 0.0)[:count]
+
+    def respawn(self, slots, spread=10.0, shade=100.0,
+                offset=np.array((0,0,0), 'f')):
+        """ reset all given slots at once around offset, with random jitter """
+        count = len(slots)
+        rdm = (np.random.randint(0, 100, count) - 50) / spread
+        rColor = 0.5 + np.random.randint(0, 100, count) / shade
+        self.position[slots] = rdm[:, None] + offset  # obj.position
+        self.color[slots, :3] = rColor[:, None]
+        self.color[slots, 3] = 1.0
+        self.life[slots] = 1.0
+        self.velocity[slots] = np.array((0,1,0), 'f') * 0.1  # obj.velocity
+
+    def integrate(self, dt, fade=0.0):
+        """ age, move and fade every slot, dead slots are simply ignored """
+        self.life -= dt
+        self.position -= self.velocity * dt
+        if fade:
+            self.color[:, 3] -= dt * fade
 
 
 # -----------------------------------------------------------------------------
 class ParticleGenerator:
-    """ particle object """
+    """ particle emitter, all living particles drawn in one instanced call """
 
-    def __init__(self, file, amount=500):
+    def __init__(self, file, amount=500, life=20.1):
 
         # setup mesh and attribute properties
         position = np.array(((0,1),(1,0),(0,0),(0,1),(1,1),(1,0)), 'f')
         texCoords = np.array(((0,1),(1,0),(0,0),(0,1),(1,1),(1,0)), 'f')
 
-        # setup texture and upload it to GPU
-        self.texture = Texture(file)
+        # setup texture and upload it to GPU, shared with same file users
+        self.texture = textures.acquire(file)
 
-        self.vertex_array = VertexArray([position, texCoords])
-
-        self.particles = [Particle()] * amount
+        self.particles = ParticleArrays(amount, life=life)
         self.amount = amount
-        self.lastUsedParticle = 0
 
+        # quad shared by all particles, offset and color streamed per instance
+        self.vertex_array = VertexArray([position, texCoords,
+                                         self.particles.position,
+                                         self.particles.color],
+                                        divisors=(0, 0, 1, 1), stream=(2, 3))
 
     def draw(self, projection, view, model, **param):
-        for p in self.particles:
-            print(p.life)
-            if (p.life > 0.0):
-       
-                self.shader = param['texture_shader_particle']
-
-                GL.glUseProgram(self.shader.glid)
-
-                GL.glEnable(GL.GL_BLEND)
-
-                # Use additive blending to give it a 'glow' effect
-                GL.glBlendFunc(GL.GL_SRC_ALPHA, GL.GL_ONE)
-
-                # draw code in the rendering loop
-                self.vertex_array.execute(GL.GL_TRIANGLES)
-
-                # only used for uniform
-                color = p.color
-                my_color_location = GL.glGetUniformLocation(self.shader.glid, 'color')
-                GL.glUniform4fv(my_color_location, 1, color)
-
-                position = p.position
-                my_position_location = GL.glGetUniformLocation(self.shader.glid, 'offset')
-                GL.glUniform2fv(my_position_location, 1, position)
+        alive = self.particles.alive()
+        count = np.count_nonzero(alive)
+        if count == 0:
+            return
 
-                matrix_location = GL.glGetUniformLocation(self.shader.glid, 'projection')
-                GL.glUniformMatrix4fv(matrix_location, 1, True, projection)
+        # upload the living particles only, in buffers not used by the GPU
+        self.vertex_array.update(2, self.particles.position[alive])
+        self.vertex_array.update(3, self.particles.color[alive])
 
-                # texture access setups
-                loc = GL.glGetUniformLocation(self.shader.glid, 'sprite')
-                GL.glActiveTexture(GL.GL_TEXTURE0) # activate the 0th texture unit ; ith unit to generalize
-                GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture.glid) # associates an existing OpenGL texture to the corresponding texture unit
-                GL.glUniform1i(loc, 0) # sampler is treated as a uniform integer variable, to which we pass the number of the texture unit
-                self.vertex_array.execute(GL.GL_TRIANGLES)
+        self.shader = param['texture_shader_particle']
 
-                # Don't forget to reset to default blending mode
-                GL.glBlendFunc(GL.GL_SRC_ALPHA, GL.GL_ONE_MINUS_SRC_ALPHA)
+        # Use additive blending to give it a 'glow' effect, once opaque
+        # objects are drawn
+        queue.submit(self.shader, self.vertex_array,
+                     dict(projection=projection, sprite=0),
+                     [(GL.GL_TEXTURE_2D, self.texture, None)],
+                     layer=TRANSPARENT, blend=ADDITIVE, instances=count)
 
 
     def update(self, dt=0.0, obj=0, newParticles=2, offset=np.array((0,0,0), 'f')):
 
-        for i in range(0, newParticles):
-            unusedParticle = self.firstUnusedParticle()
-            self.respawnParticle(self.particles[unusedParticle], obj, offset)
-
-        for i in range(0, self.amount):
-            p = self.particles[i]
-            p.life -= dt
-
-            if p.life > 0.0:
-                p.position -= p.velocity * dt
-                p.color[-1] -= dt * 2.5
-
-
-    def firstUnusedParticle(self):
-        
-        for i in range(self.lastUsedParticle, self.amount):
-            if self.particles[i].life <= 0.0:
-                self.lastUsedParticle = i
-                return i
-
-        for i in range(0, self.lastUsedParticle):
-            if self.particles[i].life <= 0.0:
-                self.lastUsedParticle = i
-                return i
-
-        self.lastUsedParticle = 0
-        return 0
-
-    def respawnParticle(self, particle, obj=0, offset=np.array((0,0,0), 'f')):
-        
-        rdm = ((random.randint(0, 32767) % 100) - 50) / 10.0
-        rColor = 0.5 + ((random.randint(0, 32767) % 100) / 100.0)
-        p = np.array((0,0,0), 'f')
-        particle.position = p + rdm + offset # obj.position
-        particle.color = np.array((rColor, rColor, rColor, 1.0), 'f')
-        particle.life = 1.0
-        v = np.array((0,1,0), 'f')
-        particle.velocity = v * 0.1 # obj.velocity
+        # respawn in free slots only, no scan over the living particles
+        self.particles.respawn(self.particles.free_slots(newParticles),
+                               offset=offset)
+        self.particles.integrate(dt, fade=2.5)
@@ -0,0 +1,131 @@
+"""
+Frame time instrumentation.
+CPU scoped timers, GPU frame timer queries and counters, accumulated per
+frame and kept over a rolling window of recent frames, for percentiles,
+JSON/CSV export and a short summary shown in the viewer window title.
+"""
+# Python built-in modules
+import csv                          # per frame samples export
+import ctypes                       # 64 bits query results
+import json                         # statistics export
+import time                         # CPU timers
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# External, non built-in modules
+import OpenGL.GL as GL              # standard Python OpenGL wrapper
+import numpy as np                  # all matrix manipulations & OpenGL args
+# raw entry point: PyOpenGL has no array handler for 64 bits results
+from OpenGL.raw.GL.VERSION.GL_3_3 import glGetQueryObjectui64v
+
+
+class Profiler:
+    """ Per frame CPU timings (ms), GPU time (ms) & counters of last frames.
+        GPU timer queries are read frames later, only once their result is
+        available, so that profiling never stalls the pipeline """
+    def __init__(self, history=600, enabled=True):
+        self.enabled = enabled
+        self.detailed = False  # opt in scopes per scene node & render item
+        self.frames = deque(maxlen=history)  # dict of metric => value
+        self.current = defaultdict(float)    # metrics of frame in progress
+        self.queries, self.pending = [], deque()  # free, in flight queries
+        self.result = ctypes.c_uint64()           # query result output
+        self.count_frames = 0
+
+    @contextmanager
+    def scope(self, name):
+        """ context timing its block, accumulated in frame metric name """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.current[name] += (time.perf_counter() - start) * 1000
+
+    def count(self, name, value=1):
+        """ add value to frame counter name """
+        if self.enabled:
+            self.current[name] += value
+
+    def begin_frame(self):
+        """ start a frame, and its GPU timer if a query object is free """
+        self.start = time.perf_counter()
+        self.query = None
+        if not self.enabled:
+            return
+        if not self.queries and len(self.pending) < 3:
+            self.queries.extend(GL.glGenQueries(1))
+        if self.queries:
+            self.query = self.queries.pop()
+            GL.glBeginQuery(GL.GL_TIME_ELAPSED, self.query)
+
+    def end_frame(self):
+        """ close frame metrics, collect GPU times of previous frames """
+        if not self.enabled:
+            return
+        self.current['frame'] = (time.perf_counter() - self.start) * 1000
+        frame = dict(self.current, index=self.count_frames)
+        self.frames.append(frame)
+        self.current.clear()
+        self.count_frames += 1
+        if self.query is not None:
+            GL.glEndQuery(GL.GL_TIME_ELAPSED)
+            self.pending.append((frame, self.query))
+
+        while self.pending:
+            frame, query = self.pending[0]
+            if not GL.glGetQueryObjectiv(query, GL.GL_QUERY_RESULT_AVAILABLE):
+                break
+            glGetQueryObjectui64v(query, GL.GL_QUERY_RESULT, self.result)
+            frame['gpu'] = self.result.value / 1e6  # from nanoseconds
+            self.queries.append(self.pending.popleft()[1])
+
+    def metrics(self):
+        """ names of all metrics recorded in kept frames """
+        names = {name for frame in self.frames for name in frame}
+        return sorted(names - {'index'})
+
+    def stats(self):
+        """ dict of metric => mean, percentiles & max over kept frames """
+        stats = {}
+        for name in self.metrics():
+            values = np.array([frame.get(name, 0.) for frame in self.frames])
+            p50, p95, p99 = np.percentile(values, (50, 95, 99))
+            stats[name] = dict(mean=values.mean(), p50=p50, p95=p95, p99=p99,
+                               max=values.max())
+        return stats
+
+    def summary(self):
+        """ one line overview of recent frames, e.g. for a window title """
+        stats = self.stats()
+        if not stats:
+            return ''
+        text = 'frame %.1fms (p95 %.1f)' % (stats['frame']['p50'],
+                                            stats['frame']['p95'])
+        for name, label in (('gpu', 'gpu %.1fms'), ('draw calls', '%d draws'),
+                            ('state changes', '%d states'),
+                            ('uploaded bytes', '%.0fkB up')):
+            if name in stats:
+                scale = 1e-3 if name == 'uploaded bytes' else 1
+                text += ', ' + label % (stats[name]['p50'] * scale)
+        return text
+
+    def export(self, file):
+        """ save statistics as JSON, or per frame samples if file is .csv """
+        if file.endswith('.csv'):
+            names = self.metrics()
+            with open(file, 'w', newline='') as output:
+                writer = csv.writer(output)
+                writer.writerow(['index'] + names)
+                for frame in self.frames:
+                    writer.writerow([frame['index']] +
+                                    [frame.get(name, 0.) for name in names])
+        else:
+            with open(file, 'w') as output:
+                json.dump(dict(frames=len(self.frames), stats=self.stats()),
+                          output, indent=2)
+
+
+profiler = Profiler()  # profiler shared by the whole process
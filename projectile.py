@@ -2,7 +2,8 @@ from keyframe import *
 from transform import quaternion_from_axis_angle
 from transform import get_scale_matrix1D
 from transform import quaternion_mul
-from mesh import load_textured
+from loader import assets
+from mesh import ProxySphere
 import glfw
 import numpy as np
 
@@ -12,8 +13,9 @@ class Projectile(KeyFrameControlNode):
     #vrot is the axis of the rotation during time, with periode
     #period
     #vrot_init and angle_init are for the initial rotation
+    #rayon is the rough model radius, for the placeholder shown while loading
     def __init__(self, objet, position_init, vrot, periode,
-                 vrot_init, angle_init, scale, vitesse):
+                 vrot_init, angle_init, scale, vitesse, rayon=500):
         translate = {0: position_init, 1: position_init}
         scale2 = {0: scale, 1: scale}
         self.vitesse = vitesse;
@@ -29,17 +31,18 @@ class Projectile(KeyFrameControlNode):
                            periode: quaternion()}
         if(periode == 0):
             rotate_keys = {0: self.rot_init, 1: self.rot_init}
-        super().__init__(translate, rotate_keys, scale2)
-        self.add(*load_textured(objet))
+        # keys keep being appended ahead of time: only recent ones are kept
+        super().__init__(translate, rotate_keys, scale2, window=2)
+        # meshes added once loaded, a sphere about their size meanwhile
+        assets.load_textured(objet, self, [ProxySphere(rayon)])
 
     #Update position with the speed
-    def draw(self, projection, view, model, win, **param):
+    def update(self, time, win=None):
         #param['position'] = self.get_position()
         taille = self.get_Taille_trans()
-        if(glfw.get_time()> taille):
+        if(time> taille):
             self.add_value_trans(taille + 1,
                 self.get_last_value_trans() + self.vitesse)
-        super().draw(projection, view, model, win, **param)
 
 
 class ProjectileGuide(Projectile):
@@ -57,30 +60,29 @@ class ProjectileGuide(Projectile):
         super().__init__(objet,vec(0,0,0), vrot, periode,
                          vrot_init,angle_init,scale, vitesse)
 
-    def draw(self, projection, view, model, win, **param):
+    def update(self, time, win=None):
         '''if(np.linalg.norm(self.position)==0):
 
-            time =glfw.get_time() +1
+            time =clock.get_time() +1
             self.add_value_trans(time,
                                  self.depart.get_position()/
                                  get_scale_matrix1D(model))'''
-        if glfw.get_key(win, glfw.KEY_D) == glfw.PRESS:
+        if win is not None and glfw.get_key(win, glfw.KEY_D) == glfw.PRESS:
             self.prepa=True
 
         if(self.is_arrive()):
             self.prepa=False
 
         if(self.prepa==False):
-            time = glfw.get_time()+0.4
-            self.add_value_trans(time,
+            self.add_value_trans(time + 0.4,
                                  self.depart.get_position()/
-                                 get_scale_matrix1D(model))
+                                 get_scale_matrix1D(self.get_model()))
         self.update_speed()
         taille = self.get_Taille_rota()
-        if(glfw.get_time()> taille):
+        if(time> taille):
             self.add_value_rota(taille + 1,
                 self.compute_quaternion())
-        super().draw(projection, view, model, win, **param)
+        super().update(time, win)
 
     def update_speed(self):
         speed = self.vitesse
@@ -0,0 +1,131 @@
+"""
+Sorted render queue.
+Drawables submit render items during traversal instead of drawing right
+away. The queue then draws them pass by pass, sorted by program, textures
+and vertex array, issuing only the bindings which differ from those of the
+previous item. No binding is reset between draws.
+"""
+# External, non built-in modules
+import OpenGL.GL as GL              # standard Python OpenGL wrapper
+
+from profiler import profiler
+
+# passes, drawn in this order: transparent items need opaque ones drawn first
+BACKGROUND, OPAQUE, TRANSPARENT = range(3)
+ADDITIVE = (GL.GL_SRC_ALPHA, GL.GL_ONE)  # blend function of glowing items
+
+
+class RenderState:
+    """ Last GL bindings made through it, so that unchanged ones are skipped.
+        Must be reset whenever GL state was changed by other means """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """ forget all bindings: next requests are all issued """
+        self.program, self.vertex_array, self.blend = -1, -1, -1
+        self.unit = -1
+        self.textures, self.samplers = {}, {}  # unit => bound glid
+
+    def use_program(self, glid):
+        if glid != self.program:
+            GL.glUseProgram(glid)
+            profiler.count('state changes')
+            self.program = glid
+
+    def bind_texture(self, unit, target, glid, sampler=0):
+        if self.textures.get(unit) != (target, glid):
+            if unit != self.unit:
+                GL.glActiveTexture(GL.GL_TEXTURE0 + unit)
+                profiler.count('state changes')
+                self.unit = unit
+            GL.glBindTexture(target, glid)
+            profiler.count('state changes')
+            self.textures[unit] = (target, glid)
+        if self.samplers.get(unit) != sampler:
+            GL.glBindSampler(unit, sampler)
+            profiler.count('state changes')
+            self.samplers[unit] = sampler
+
+    def bind_vertex_array(self, glid):
+        if glid != self.vertex_array:
+            GL.glBindVertexArray(glid)
+            profiler.count('state changes')
+            self.vertex_array = glid
+
+    def set_blend(self, blend):
+        """ blend function as (source, destination) factors, None disables """
+        if blend != self.blend:
+            if blend is None:
+                GL.glDisable(GL.GL_BLEND)
+            else:
+                if self.blend in (None, -1):
+                    GL.glEnable(GL.GL_BLEND)
+                GL.glBlendFunc(*blend)
+            profiler.count('state changes')
+            self.blend = blend
+
+
+class RenderItem:
+    """ One draw call, with everything needed to issue it later """
+    __slots__ = ('key', 'shader', 'vertex_array', 'uniforms', 'textures',
+                 'blend', 'primitive', 'instances', 'level', 'label')
+
+    def __init__(self, layer, shader, vertex_array, uniforms, textures, blend,
+                 primitive, instances, level, label):
+        self.key = (layer, shader.glid,
+                    tuple(texture.glid for _, texture, _ in textures),
+                    vertex_array.glid)
+        self.shader, self.vertex_array = shader, vertex_array
+        self.uniforms, self.textures, self.blend = uniforms, textures, blend
+        self.primitive, self.instances, self.level = primitive, instances, level
+        self.label = label  # profiler scope of its draw, if detailed
+
+
+class RenderQueue:
+    """ Render items of a frame, drawn with minimal state changes on flush """
+    def __init__(self):
+        self.items = []
+        self.state = RenderState()
+        self.label = None  # of items submitted now, set by detailed profiling
+
+    def submit(self, shader, vertex_array, uniforms, textures=(),
+               layer=OPAQUE, blend=None, primitive=GL.GL_TRIANGLES,
+               instances=None, level=0):
+        """ queue a draw of vertex_array with shader, given uniform values
+            and (target, texture, sampler or None) per texture unit """
+        self.items.append(RenderItem(layer, shader, vertex_array, uniforms,
+                                     textures, blend, primitive, instances,
+                                     level, self.label))
+
+    def flush(self):
+        """ draw and empty queued items, sorted to share state. Python sort
+            being stable, items of same key keep their submission order """
+        state = self.state
+        state.reset()  # bindings may have changed since last flush
+        self.items.sort(key=lambda item: item.key)
+        for item in self.items:
+            if profiler.detailed:  # CPU time of each item, keyed by source
+                with profiler.scope('flush %s' % (
+                        item.label or type(item.vertex_array).__name__)):
+                    self.issue(item)
+            else:
+                self.issue(item)
+        self.items.clear()
+        # no vertex array left bound, for buffer uploads outside the queue
+        state.bind_vertex_array(0)
+
+    def issue(self, item):
+        """ bind what item needs, unless already bound, and draw it """
+        state = self.state
+        state.use_program(item.shader.glid)
+        state.set_blend(item.blend)
+        for unit, (target, texture, sampler) in enumerate(item.textures):
+            state.bind_texture(unit, target, texture.glid,
+                               sampler.glid if sampler else 0)
+        item.shader.set_uniforms(**item.uniforms)
+        state.bind_vertex_array(item.vertex_array.glid)
+        item.vertex_array.draw(item.primitive, item.instances, item.level)
+
+
+queue = RenderQueue()  # queue shared by the whole process
@@ -0,0 +1,129 @@
+"""
+Asset path resolution from prebuilt directory indexes.
+An asset root is walked once, then files are looked up by normalized base
+name. Indexes are persisted with directory modification times, so that a
+refresh only lists the directories which actually changed.
+"""
+# Python built-in modules
+import hashlib                      # persisted index file names
+import json                         # persisted index format
+import os                           # os function, i.e. checking file status
+import threading                    # resolver is used from loader threads
+import time                         # index refresh rate limiting
+
+from meshcache import CACHE_DIR
+
+REFRESH_INTERVAL = 5.0  # seconds between refreshes of an index on lookup miss
+
+
+def normalized_name(name):
+    """ comparable base name of a path written on any system """
+    return name.replace('\\', '/').split('/')[-1].lower()
+
+
+class AssetIndex:
+    """ Index of all files below root, by normalized base name """
+    def __init__(self, root, persist=True):
+        self.root = os.path.abspath(root)
+        key = hashlib.sha1(self.root.encode()).hexdigest()
+        self.file = os.path.join(CACHE_DIR, 'index_%s.json' % key) \
+            if persist else None
+        self.dirs = {}   # directory => [mtime, sub directories, file names]
+        self.names = {}  # normalized base name => list of full paths
+        try:
+            with open(self.file) as index_file:
+                self.dirs = json.load(index_file)
+        except (TypeError, OSError, ValueError):
+            pass
+        self.refresh()
+
+    def refresh(self):
+        """ update index, only listing directories whose mtime changed """
+        self.refreshed = time.monotonic()
+        dirs, changed, todo = {}, False, [self.root]
+        while todo:
+            directory = todo.pop()
+            try:
+                mtime = os.stat(directory).st_mtime
+                entry = self.dirs.get(directory)
+                if entry is None or entry[0] != mtime:
+                    entries = list(os.scandir(directory))
+                    entry = [mtime, [e.path for e in entries if e.is_dir()],
+                             [e.name for e in entries if e.is_file()]]
+                    changed = True
+            except OSError:
+                continue
+            dirs[directory] = entry
+            todo.extend(entry[1])
+        changed = changed or len(dirs) != len(self.dirs)
+        self.dirs = dirs
+
+        self.names = {}
+        for directory, (_, _, files) in dirs.items():
+            for name in files:
+                path = os.path.join(directory, name)
+                self.names.setdefault(normalized_name(name), []).append(path)
+
+        if changed and self.file:
+            try:
+                os.makedirs(os.path.dirname(self.file), exist_ok=True)
+                with open(self.file, 'w') as index_file:
+                    json.dump(self.dirs, index_file)
+            except OSError as error:
+                print('WARNING: unable to save asset index (%s)' % error)
+
+    def find(self, name, folder=None):
+        """ full path of file name below folder (anywhere if None), None if
+            not found. Falls back to prefix matching of base names """
+        name = normalized_name(name)
+        folder = os.path.join(os.path.abspath(folder), '') if folder else ''
+        below = lambda paths: [p for p in paths if p.startswith(folder)]
+        paths = below(self.names.get(name, []))
+        if not paths:  # path often screwed up: fuzzy prefix search
+            paths = below(p for other, group in sorted(self.names.items())
+                          if name.startswith(other) or other.startswith(name)
+                          for p in group)
+        return sorted(paths)[0] if paths else None
+
+
+class AssetResolver:
+    """ Finds asset files through indexes of asset roots, built on demand
+        for the folder of a lookup if no declared root already covers it """
+    def __init__(self):
+        self.indexes = {}  # root => AssetIndex
+        self.lock = threading.Lock()
+
+    def add_root(self, root):
+        """ declare a shared asset root, indexed once for all its folders """
+        with self.lock:
+            root = os.path.abspath(root)
+            if root not in self.indexes:
+                self.indexes[root] = AssetIndex(root)
+            return self.indexes[root]
+
+    def index(self, folder):
+        """ index of the widest known root containing folder """
+        folder = os.path.abspath(folder)
+        with self.lock:
+            for root in sorted(self.indexes, key=len):
+                if folder == root or folder.startswith(os.path.join(root, '')):
+                    return self.indexes[root]
+        return self.add_root(folder)
+
+    def find(self, name, folder):
+        """ path of asset name below folder, None if none matches even
+            after refreshing the index in case files were added. The whole
+            root being walked again, an index is refreshed at most once per
+            REFRESH_INTERVAL, so that the misses of a model with several
+            missing files cost one walk """
+        index = self.index(folder)
+        with self.lock:
+            path = index.find(name, folder)
+            if path is None and \
+                    time.monotonic() - index.refreshed > REFRESH_INTERVAL:
+                index.refresh()
+                path = index.find(name, folder)
+        return path
+
+
+resolver = AssetResolver()  # resolver shared by the whole process
@@ -1,12 +1,74 @@
+import ctypes                       # transform feedback varying names
 import OpenGL.GL as GL      # standard Python OpenGL wrapper
+import numpy as np                  # uniform values comparison & formatting
 import os                           # os function, i.e. checking file status
+import hashlib                      # program registry keys from sources
+
+from profiler import profiler
+
+
+# uniform type => (upload function, numpy format, components, is matrix)
+UNIFORM_SETTERS = {
+    GL.GL_FLOAT: (GL.glUniform1fv, 'f', 1, False),
+    GL.GL_FLOAT_VEC2: (GL.glUniform2fv, 'f', 2, False),
+    GL.GL_FLOAT_VEC3: (GL.glUniform3fv, 'f', 3, False),
+    GL.GL_FLOAT_VEC4: (GL.glUniform4fv, 'f', 4, False),
+    GL.GL_INT: (GL.glUniform1iv, 'i', 1, False),
+    GL.GL_INT_VEC2: (GL.glUniform2iv, 'i', 2, False),
+    GL.GL_INT_VEC3: (GL.glUniform3iv, 'i', 3, False),
+    GL.GL_INT_VEC4: (GL.glUniform4iv, 'i', 4, False),
+    GL.GL_UNSIGNED_INT: (GL.glUniform1uiv, 'I', 1, False),
+    GL.GL_UNSIGNED_INT_VEC2: (GL.glUniform2uiv, 'I', 2, False),
+    GL.GL_UNSIGNED_INT_VEC3: (GL.glUniform3uiv, 'I', 3, False),
+    GL.GL_UNSIGNED_INT_VEC4: (GL.glUniform4uiv, 'I', 4, False),
+    GL.GL_BOOL: (GL.glUniform1iv, 'i', 1, False),
+    GL.GL_BOOL_VEC2: (GL.glUniform2iv, 'i', 2, False),
+    GL.GL_BOOL_VEC3: (GL.glUniform3iv, 'i', 3, False),
+    GL.GL_BOOL_VEC4: (GL.glUniform4iv, 'i', 4, False),
+    GL.GL_FLOAT_MAT2: (GL.glUniformMatrix2fv, 'f', 4, True),
+    GL.GL_FLOAT_MAT3: (GL.glUniformMatrix3fv, 'f', 9, True),
+    GL.GL_FLOAT_MAT4: (GL.glUniformMatrix4fv, 'f', 16, True),
+    GL.GL_FLOAT_MAT2x3: (GL.glUniformMatrix2x3fv, 'f', 6, True),
+    GL.GL_FLOAT_MAT2x4: (GL.glUniformMatrix2x4fv, 'f', 8, True),
+    GL.GL_FLOAT_MAT3x2: (GL.glUniformMatrix3x2fv, 'f', 6, True),
+    GL.GL_FLOAT_MAT3x4: (GL.glUniformMatrix3x4fv, 'f', 12, True),
+    GL.GL_FLOAT_MAT4x2: (GL.glUniformMatrix4x2fv, 'f', 8, True),
+    GL.GL_FLOAT_MAT4x3: (GL.glUniformMatrix4x3fv, 'f', 12, True),
+}
+# all GL 3.3 sampler types are set as their texture unit number
+for sampler in ('1D', '2D', '3D', 'CUBE', '1D_SHADOW', '2D_SHADOW',
+                'CUBE_SHADOW', '1D_ARRAY', '2D_ARRAY', '1D_ARRAY_SHADOW',
+                '2D_ARRAY_SHADOW', '2D_MULTISAMPLE', '2D_MULTISAMPLE_ARRAY',
+                'BUFFER', '2D_RECT', '2D_RECT_SHADOW'):
+    for prefix in ('', 'INT_', 'UNSIGNED_INT_'):
+        if 'SHADOW' in sampler and prefix:
+            continue  # shadow samplers are float only
+        kind = getattr(GL, 'GL_%sSAMPLER_%s' % (prefix, sampler), None)
+        if kind is not None:
+            UNIFORM_SETTERS[kind] = (GL.glUniform1iv, 'i', 1, False)
+
 
 class Shader:
     """ Helper class to create and automatically destroy shader program """
     @staticmethod
-    def _compile_shader(src, shader_type):
+    def _read_source(src, defines=None):
+        """ source text from raw string or file name, with #define lines
+            inserted right after the #version directive if any """
+        if src is None:
+            return ''
         src = open(src, 'r').read() if os.path.exists(src) else src
         src = src.decode('ascii') if isinstance(src, bytes) else src
+        if defines:
+            lines = ['#define %s %s' % item for item in sorted(defines.items())]
+            head, _, tail = src.partition('\n')
+            if head.startswith('#version'):
+                src = '\n'.join([head] + lines + [tail])
+            else:
+                src = '\n'.join(lines + [src])
+        return src
+
+    @staticmethod
+    def _compile_shader(src, shader_type):
         shader = GL.glCreateShader(shader_type)
         GL.glShaderSource(shader, src)
         GL.glCompileShader(shader)
@@ -20,27 +82,129 @@ class Shader:
             return None
         return shader
 
-    def __init__(self, vertex_source, fragment_source):
-        """ Shader can be initialized with raw strings or source file names """
+    def __init__(self, vertex_source, fragment_source, defines=None,
+                 varyings=()):
+        """ Shader can be initialized with raw strings or source file names,
+            optional defines dict is prepended to both stages as #define.
+            Fragment source may be None for programs only capturing the
+            named vertex shader output varyings, interleaved in this order,
+            to a transform feedback buffer """
         self.glid = None
-        vert = self._compile_shader(vertex_source, GL.GL_VERTEX_SHADER)
-        frag = self._compile_shader(fragment_source, GL.GL_FRAGMENT_SHADER)
+        self.key = ShaderRegistry.key(vertex_source, fragment_source, defines,
+                                      varyings)
+        vert = self._compile_shader(self._read_source(vertex_source, defines),
+                                    GL.GL_VERTEX_SHADER)
+        frag = self._compile_shader(self._read_source(fragment_source, defines),
+                                    GL.GL_FRAGMENT_SHADER) \
+            if fragment_source is not None else -1
         if vert and frag:
             self.glid = GL.glCreateProgram()  # pylint: disable=E1111
             GL.glAttachShader(self.glid, vert)
-            GL.glAttachShader(self.glid, frag)
+            if fragment_source is not None:
+                GL.glAttachShader(self.glid, frag)
+            if varyings:
+                strings = [ctypes.create_string_buffer(name.encode('ascii'))
+                           for name in varyings]
+                names = (ctypes.POINTER(ctypes.c_char) * len(varyings))(
+                    *(ctypes.cast(string, ctypes.POINTER(ctypes.c_char))
+                      for string in strings))
+                GL.glTransformFeedbackVaryings(self.glid, len(varyings), names,
+                                               GL.GL_INTERLEAVED_ATTRIBS)
             GL.glLinkProgram(self.glid)
             GL.glDeleteShader(vert)
-            GL.glDeleteShader(frag)
+            if fragment_source is not None:
+                GL.glDeleteShader(frag)
             status = GL.glGetProgramiv(self.glid, GL.GL_LINK_STATUS)
             if not status:
                 print(GL.glGetProgramInfoLog(self.glid).decode('ascii'))
                 GL.glDeleteProgram(self.glid)
                 self.glid = None
 
+        # introspect active uniforms once: name => (location, type)
+        self.uniforms, self.values = {}, {}
+        nb_uniforms = GL.glGetProgramiv(self.glid, GL.GL_ACTIVE_UNIFORMS) \
+            if self.glid else 0
+        for i in range(nb_uniforms):
+            name, _size, kind = GL.glGetActiveUniform(self.glid, i)
+            name = name.decode('ascii').split('[')[0]  # 'array[0]' => 'array'
+            location = GL.glGetUniformLocation(self.glid, name)
+            self.uniforms[name] = (location, kind)
+            if kind not in UNIFORM_SETTERS:
+                print('WARNING: uniform %s of unsupported type %s is ignored'
+                      % (name, kind))
+
+    def location(self, name):
+        """ cached location of named uniform, -1 if not an active uniform """
+        return self.uniforms.get(name, (-1,))[0]
+
+    def set_uniform(self, name, value):
+        """ upload value to named uniform of this program, which must be in
+            use. Uploads are skipped if value did not change since last one,
+            and names not active in the program are silently ignored """
+        if name not in self.uniforms:
+            return
+        location, kind = self.uniforms[name]
+        if kind not in UNIFORM_SETTERS:
+            return  # warned about once at link time
+        upload, dtype, components, matrix = UNIFORM_SETTERS[kind]
+        value = np.asarray(value, dtype)
+        last = self.values.get(name)
+        if last is not None and np.array_equal(last, value):
+            return
+        self.values[name] = value.copy()
+        count = max(1, value.size // components)
+        profiler.count('uniform uploads')
+        if matrix:
+            upload(location, count, True, value)
+        else:
+            upload(location, count, value)
+
+    def set_uniforms(self, **values):
+        """ upload several named uniforms at once, see set_uniform """
+        for name, value in values.items():
+            self.set_uniform(name, value)
+
     def __del__(self):
         GL.glUseProgram(0)
         if self.glid:                      # if this is a valid shader object
             GL.glDeleteProgram(self.glid)  # object dies => destroy GL object
 
 
+
+
+class ShaderRegistry:
+    """ Process wide cache of linked programs, keyed by hash of their vertex
+        and fragment sources and defines. Programs are shared between users
+        and reference counted: destroyed when the last user releases them """
+    def __init__(self):
+        self.programs = {}  # key => [shader, number of users]
+
+    @staticmethod
+    def key(vertex_source, fragment_source, defines=None, varyings=()):
+        """ hash identifying a program built from these sources, defines &
+            captured varyings """
+        sources = (Shader._read_source(vertex_source, defines),
+                   Shader._read_source(fragment_source, defines)) + \
+            tuple(varyings)
+        return hashlib.sha1('\0'.join(sources).encode()).hexdigest()
+
+    def acquire(self, vertex_source, fragment_source, defines=None,
+                varyings=()):
+        """ shared Shader for these sources, compiled on first request only """
+        key = self.key(vertex_source, fragment_source, defines, varyings)
+        if key not in self.programs:
+            shader = Shader(vertex_source, fragment_source, defines, varyings)
+            self.programs[key] = [shader, 0]
+        self.programs[key][1] += 1
+        return self.programs[key][0]
+
+    def release(self, shader):
+        """ give back a shader obtained with acquire, last user frees it """
+        entry = self.programs.get(shader.key)
+        if entry and entry[0] is shader:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.programs[shader.key]
+
+
+shaders = ShaderRegistry()  # registry shared by the whole process
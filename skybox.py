@@ -6,6 +6,8 @@ import pyassimp                     # 3D resource loader
 import pyassimp.errors              # Assimp error management + exceptions
 
 from vertex import *
+from profiler import profiler
+from render import queue, BACKGROUND
 
 # -------------- OpenGL Cubemap Texture Wrapper --------------------------------
 class Cubemap:
@@ -25,6 +27,7 @@ class Cubemap:
                 tex = np.array(Image.open(file[i]))
                 GL.glTexImage2D(textureID[i], 0, GL.GL_RGBA, tex.shape[1],
                                 tex.shape[0], 0, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, tex)
+                profiler.count('uploaded bytes', tex.nbytes)
 
             # pass texture parameters that control how a texture wraps when addressed outside the 
             # standard range of [0,1]^2 and to control texel interpolation
@@ -61,6 +64,7 @@ class Skybox:
         position = position*100
 
         self.vertex_array = VertexArray([position])
+        self.vertex_array.box = None  # drawn around the camera: never culled
 
         self.file = file
 
@@ -72,19 +76,13 @@ class Skybox:
 
         self.shader = _kwargs['texture_shader_skybox']
 
-        GL.glUseProgram(self.shader.glid)
+        # projection geometry, shared by the whole frame if given
+        viewprojection = _kwargs.get('viewprojection')
+        if viewprojection is None:
+            viewprojection = projection @ view
 
-        # projection geometry
-        loc = GL.glGetUniformLocation(self.shader.glid, 'viewprojection')
-        GL.glUniformMatrix4fv(loc, 1, True, projection @ view)
-
-        # texture access setups
-        loc = GL.glGetUniformLocation(self.shader.glid, 'skybox')
-        GL.glActiveTexture(GL.GL_TEXTURE0) # activate the 0th texture unit ; ith unit to generalize
-        GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, self.texture.glid) # associates an existing OpenGL texture to the corresponding texture unit
-        GL.glUniform1i(loc, 0) # sampler is treated as a uniform integer variable, to which we pass the number of the texture unit
-        self.vertex_array.execute(GL.GL_TRIANGLES)
-
-        # leave clean state for easier debugging
-        GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, 0)
-        GL.glUseProgram(0)
\ No newline at end of file
+        # cubemap on unit 0, drawn before everything else
+        queue.submit(self.shader, self.vertex_array,
+                     dict(viewprojection=viewprojection, skybox=0),
+                     [(GL.GL_TEXTURE_CUBE_MAP, self.texture, None)],
+                     layer=BACKGROUND)
\ No newline at end of file
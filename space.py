@@ -1,7 +1,8 @@
 import math
 from node import *
 from keyframe import *
-from mesh import load_textured
+from loader import assets
+from mesh import ProxySphere
 from transform import Trackball, identity, translate, rotate, scale, lerp, vec
 from transform import (quaternion_slerp, quaternion_matrix, quaternion,
                        quaternion_from_euler,
@@ -26,12 +27,12 @@ class Planete(KeyFrameControlNode):
         self.rayonModel = rayon
         self.rayon = rayon
         super().__init__(translate, rotate, scale, name, **kwargs)
-        self.add(*load_textured(planete))
+        # meshes added once loaded, a sphere of the planet radius meanwhile
+        assets.load_textured(planete, self, [ProxySphere(rayon)])
 
 
-    def draw(self, projection, view, model, win, **param):
-       self.rayon = self.rayonModel*get_scale_matrix1D(model) 
-       super().draw(projection, view, model, win, **param)
+    def update(self, time, win=None):
+       self.rayon = self.rayonModel*get_scale_matrix1D(self.get_model())
 
 
     def is_Planete(self):
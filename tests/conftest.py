@@ -0,0 +1,51 @@
+""" modules of the viewer live at repository root, GL tests run offscreen """
+import ctypes
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# PyOpenGL picks its platform on first import, see headless.py
+os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+if os.environ['PYOPENGL_PLATFORM'] == 'egl':
+    os.environ.setdefault('EGL_PLATFORM', 'surfaceless')
+
+
+@pytest.fixture(scope='session')
+def gl_context():
+    """ current OpenGL 3.3 core context without surface, tests needing one
+        are skipped if EGL can't provide it """
+    try:
+        from OpenGL import EGL
+        display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor))
+        config, count = EGL.EGLConfig(), EGL.EGLint()
+        attributes = (EGL.EGLint * 3)(EGL.EGL_RENDERABLE_TYPE,
+                                      EGL.EGL_OPENGL_BIT, EGL.EGL_NONE)
+        EGL.eglChooseConfig(display, attributes, ctypes.pointer(config), 1,
+                            ctypes.pointer(count))
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        attributes = (EGL.EGLint * 7)(
+            EGL.EGL_CONTEXT_MAJOR_VERSION, 3, EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+            EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK,
+            EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT, EGL.EGL_NONE)
+        context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT,
+                                       attributes)
+        if not context or not EGL.eglMakeCurrent(
+                display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, context):
+            raise RuntimeError('no OpenGL 3.3 core context')
+    except Exception as error:  # no EGL library, driver or GPU
+        pytest.skip('OpenGL context unavailable (%s)' % error)
+
+    # no default framebuffer without surface: draws go to a 1x1 one
+    import OpenGL.GL as GL
+    framebuffer, color = GL.glGenFramebuffers(1), GL.glGenRenderbuffers(1)
+    GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, color)
+    GL.glRenderbufferStorage(GL.GL_RENDERBUFFER, GL.GL_RGBA8, 1, 1)
+    GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, framebuffer)
+    GL.glFramebufferRenderbuffer(GL.GL_FRAMEBUFFER, GL.GL_COLOR_ATTACHMENT0,
+                                 GL.GL_RENDERBUFFER, color)
+    return context
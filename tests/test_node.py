@@ -0,0 +1,30 @@
+""" Scene frustum culling tests, GL free """
+import numpy as np
+
+from node import Scene
+from transform import perspective, translate
+
+
+def planes(viewprojection):
+    """ frustum planes as computed by Scene.cull """
+    m = viewprojection
+    return np.array([m[3] + m[0], m[3] - m[0], m[3] + m[1],
+                     m[3] - m[1], m[3] + m[2], m[3] - m[2]])
+
+
+def test_inside_finite_infinite_and_empty_boxes():
+    frustum = planes(perspective(45, 1, 0.1, 100) @ translate(0, 0, -10))
+    inf = np.inf
+    lower = np.array([[-1, -1, -1],        # in view
+                      [50, 50, -1],        # out of view
+                      [-inf, -inf, -inf],  # unbounded: never culled
+                      [inf, inf, inf],     # empty: no mesh, always culled
+                      [-1, -1, 20]],       # behind the camera
+                     np.float32)
+    upper = np.array([[1, 1, 1],
+                      [52, 52, 1],
+                      [inf, inf, inf],
+                      [-inf, -inf, -inf],
+                      [1, 1, 22]], np.float32)
+    inside = Scene.inside(frustum, lower, upper)
+    assert inside.tolist() == [True, False, True, False, False]
@@ -0,0 +1,54 @@
+""" Streamed vertex attribute tests, on an offscreen GL context """
+import numpy as np
+import OpenGL.GL as GL
+import pytest
+
+from shader import Shader
+from vertex import VertexArray
+
+STREAM_VERT = """#version 330 core
+layout(location = 0) in vec3 position;
+layout(location = 1) in vec3 offset;
+void main() { gl_Position = vec4(position + offset, 1); }"""
+STREAM_FRAG = """#version 330 core
+out vec4 color;
+void main() { color = vec4(1); }"""
+
+
+def stream_rows(vertex_array, index):
+    """ rows of streamed attribute index, as read by the next draw """
+    stream = vertex_array.streams[index]
+    GL.glBindBuffer(GL.GL_ARRAY_BUFFER, stream.glid)
+    data = GL.glGetBufferSubData(GL.GL_ARRAY_BUFFER, stream.region * stream.size,
+                                 stream.size)
+    GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+    return np.frombuffer(data, np.float32).reshape(stream.capacity, -1)
+
+
+@pytest.mark.parametrize('mode', ['ring', 'orphan'])
+def test_partial_update_keeps_other_rows(gl_context, mode):
+    shader = Shader(STREAM_VERT, STREAM_FRAG)
+    positions = np.zeros((32, 3), np.float32)
+    offsets = np.arange(32 * 3, dtype=np.float32).reshape(32, 3)
+    vertex_array = VertexArray([positions, offsets], stream=(1,),
+                               stream_mode=mode)
+    GL.glUseProgram(shader.glid)
+    GL.glEnable(GL.GL_RASTERIZER_DISCARD)
+
+    vertex_array.execute(GL.GL_POINTS)
+    changed = -np.ones((10, 3), np.float32)
+    vertex_array.update(1, changed, offset=10)
+    vertex_array.execute(GL.GL_POINTS)
+    expected = offsets.copy()
+    expected[10:20] = changed
+    assert np.array_equal(stream_rows(vertex_array, 1), expected)
+
+    # once more, ring mode now copying from another region
+    vertex_array.update(1, 2 * changed[:5], offset=0)
+    vertex_array.execute(GL.GL_POINTS)
+    expected[0:5] = 2 * changed[:5]
+    assert np.array_equal(stream_rows(vertex_array, 1), expected)
+
+    GL.glDisable(GL.GL_RASTERIZER_DISCARD)
+    GL.glBindVertexArray(0)
+    assert GL.glGetError() == GL.GL_NO_ERROR
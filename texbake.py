@@ -0,0 +1,269 @@
+"""
+Baked texture cache.
+Source images are decoded once, their whole mip chain computed and stored
+in a compact format: S3TC BC1 or BC3 blocks if the driver supports them,
+else RGB8 or RGBA8, alpha being kept only if the image has transparency.
+Each cache entry holds an index.json header and one raw file of all the
+levels, memory mapped back on load and uploaded level by level.
+Run as a script to bake textures ahead of time: python texbake.py FILES...
+"""
+# Python built-in modules
+import argparse                     # command line options
+import json                         # entry index header
+import hashlib                      # entry names
+import os                           # os function, i.e. checking file status
+import tempfile                     # entry files replaced atomically
+import threading                    # baker is used from loader threads
+
+# External, non built-in modules
+import OpenGL.GL as GL              # standard Python OpenGL wrapper
+from OpenGL.GL.EXT.texture_compression_s3tc import (
+    GL_COMPRESSED_RGB_S3TC_DXT1_EXT, GL_COMPRESSED_RGBA_S3TC_DXT5_EXT)
+import numpy as np                  # all matrix manipulations & OpenGL args
+from PIL import Image               # load images for textures
+
+from meshcache import CACHE_DIR, file_hash
+
+BAKE_VERSION = 1  # bump whenever the stored layout or encoders change
+
+# format => (GL internal format, GL pixel format or None if compressed,
+#            channels, bytes per 4x4 block if compressed)
+TEXTURE_FORMATS = {
+    'rgb8': (GL.GL_RGB8, GL.GL_RGB, 3, 0),
+    'rgba8': (GL.GL_RGBA8, GL.GL_RGBA, 4, 0),
+    'bc1': (GL_COMPRESSED_RGB_S3TC_DXT1_EXT, None, 3, 8),
+    'bc3': (GL_COMPRESSED_RGBA_S3TC_DXT5_EXT, None, 4, 16),
+}
+
+
+# -------------- S3TC block encoders ------------------------------------------
+def image_blocks(image):
+    """ 4x4 texel blocks of image, edges repeated to whole blocks, as
+        (blocks, 16, channels) rows of blocks, texels in row order """
+    height, width = image.shape[:2]
+    image = np.pad(image, ((0, -height % 4), (0, -width % 4), (0, 0)),
+                   mode='edge')
+    rows, columns = image.shape[0] // 4, image.shape[1] // 4
+    return image.reshape(rows, 4, columns, 4, -1).transpose(0, 2, 1, 3, 4) \
+        .reshape(rows * columns, 16, -1)
+
+
+def rgb565(colors):
+    """ 16 bits packed colors, and the colors they decode to """
+    bits = np.round(colors * (31 / 255, 63 / 255, 31 / 255)).astype(np.uint16)
+    packed = bits[..., 0] << 11 | bits[..., 1] << 5 | bits[..., 2]
+    return packed, bits * (255 / 31, 255 / 63, 255 / 31)
+
+
+def encode_bc1(blocks):
+    """ 8 bytes BC1 color blocks of (blocks, 16, 3) colors: endpoints are
+        the extreme texels along the main color axis of each block """
+    colors = blocks.astype(np.float32)
+    centered = colors - colors.mean(axis=1, keepdims=True)
+    covariance = np.einsum('bki,bkj->bij', centered, centered)
+    axis = np.ones((len(blocks), 3), np.float32)
+    for _ in range(4):  # power iteration towards main eigenvector
+        axis = np.einsum('bij,bj->bi', covariance, axis)
+        axis /= np.maximum(np.abs(axis).max(axis=1, keepdims=True), 1e-12)
+    projection = np.einsum('bki,bi->bk', centered, axis)
+    rows = np.arange(len(blocks))
+    high = colors[rows, projection.argmax(axis=1)]
+    low = colors[rows, projection.argmin(axis=1)]
+
+    # 4 colors mode needs first endpoint greater than second one
+    packed0, color0 = rgb565(high)
+    packed1, color1 = rgb565(low)
+    swap = packed0 < packed1
+    packed0[swap], packed1[swap] = packed1[swap], packed0[swap]
+    color0[swap], color1[swap] = color1[swap], color0[swap]
+    palette = np.stack([color0, color1, (2 * color0 + color1) / 3,
+                        (color0 + 2 * color1) / 3], axis=1)
+    distances = ((colors[:, :, None] - palette[:, None]) ** 2).sum(axis=3)
+    indices = distances.argmin(axis=2).astype(np.uint32)
+    indices[packed0 == packed1] = 0  # single color block
+
+    encoded = np.zeros(len(blocks), [('color0', '<u2'), ('color1', '<u2'),
+                                     ('indices', '<u4')])
+    encoded['color0'], encoded['color1'] = packed0, packed1
+    encoded['indices'] = (indices << (2 * np.arange(16, dtype=np.uint32))) \
+        .sum(axis=1, dtype=np.uint32)
+    return encoded.view(np.uint8).reshape(len(blocks), 8)
+
+
+def encode_bc3(blocks):
+    """ 16 bytes BC3 blocks of (blocks, 16, 4) colors: BC1 color block after
+        an alpha block interpolating between block extreme alpha values """
+    alpha = blocks[:, :, 3].astype(np.float32)
+    high, low = alpha.max(axis=1), alpha.min(axis=1)
+    weights = np.array([0, 7, 6, 5, 4, 3, 2, 1]) / 7  # of high, 8 values mode
+    palette = np.round(high[:, None] * weights + low[:, None] * (1 - weights))
+    palette[:, 0], palette[:, 1] = high, low
+    indices = np.abs(alpha[:, :, None] - palette[:, None]).argmin(axis=2)
+    indices = indices.astype(np.uint64)
+    bits = (indices << (3 * np.arange(16, dtype=np.uint64))) \
+        .sum(axis=1, dtype=np.uint64)
+
+    encoded = np.zeros((len(blocks), 16), np.uint8)
+    encoded[:, 0], encoded[:, 1] = high, low
+    encoded[:, 2:8] = bits[:, None].view(np.uint8)[:, :6]  # little endian
+    encoded[:, 8:] = encode_bc1(blocks[:, :, :3])
+    return encoded
+
+
+ENCODERS = {'bc1': encode_bc1, 'bc3': encode_bc3}
+
+
+# -------------- baked texture cache ------------------------------------------
+def mip_chain(image):
+    """ image and its successive half size reductions, down to 1x1 """
+    levels = [image]
+    while image.width > 1 or image.height > 1:
+        image = image.resize((max(image.width // 2, 1),
+                              max(image.height // 2, 1)), Image.BOX)
+        levels.append(image)
+    return levels
+
+
+class BakedImage:
+    """ Mip chain of an image in a texture format, levels as (width, height,
+        bytes array) finest first, ready for upload """
+    def __init__(self, format, levels):
+        self.format, self.levels = format, levels
+        self.nbytes = sum(data.nbytes for _, _, data in levels)
+        self.shape = (levels[0][1], levels[0][0], TEXTURE_FORMATS[format][2])
+
+
+class TextureBaker:
+    """ Stores baked mip chains of source images, invalidated by source
+        modification time, size, content hash and formats supported """
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+        self.compress = False  # S3TC formats usable, see detect
+        self.lock = threading.Lock()
+        self.baking = {}       # entry => lock held while loading or baking it
+
+    def detect(self):
+        """ enable compressed formats if current GL context supports them """
+        count = GL.glGetIntegerv(GL.GL_NUM_EXTENSIONS)
+        extensions = {GL.glGetStringi(GL.GL_EXTENSIONS, i).decode()
+                      for i in range(count)}
+        self.compress = 'GL_EXT_texture_compression_s3tc' in extensions
+
+    def entry(self, file):
+        """ cache entry directory for file baked with supported formats """
+        key = '%s|%d|%d' % (os.path.realpath(file), self.compress,
+                            BAKE_VERSION)
+        return os.path.join(self.directory, 'tex_' +
+                            hashlib.sha1(key.encode()).hexdigest())
+
+    def load(self, file):
+        """ BakedImage of file, read from cache or baked and cached first.
+            Loads of a same entry are serialized, so that it is baked once """
+        with self.lock:
+            lock = self.baking.setdefault(self.entry(file), threading.Lock())
+        with lock:
+            return self.cached(file) or self.bake(file)
+
+    def cached(self, file):
+        """ BakedImage of file memory mapped from cache, None if stale """
+        entry = self.entry(file)
+        try:
+            with open(os.path.join(entry, 'index.json')) as index_file:
+                index = json.load(index_file)
+            stat = os.stat(file)
+            if (index['mtime'], index['size']) != (stat.st_mtime, stat.st_size):
+                # touched but maybe unchanged: only content hash can tell
+                if index['hash'] != file_hash(file):
+                    return None
+                index['mtime'], index['size'] = stat.st_mtime, stat.st_size
+                self.replace(entry, 'index.json', json.dumps(index).encode())
+            data = np.memmap(os.path.join(entry, 'levels.bin'), np.uint8, 'r')
+            if len(data) != sum(size for _, _, _, size in index['levels']):
+                return None  # index of another bake of the entry
+            return BakedImage(index['format'], [
+                (width, height, data[offset:offset + size])
+                for width, height, offset, size in index['levels']])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def bake(self, file):
+        """ decode file, compute & encode its mip chain, then cache it """
+        image = Image.open(file)
+        opaque = 'A' not in image.getbands() or \
+            image.getchannel('A').getextrema()[0] == 255
+        image = image.convert('RGB' if opaque else 'RGBA')
+        if self.compress:
+            format = 'bc1' if opaque else 'bc3'
+        else:
+            format = 'rgb8' if opaque else 'rgba8'
+
+        levels = []
+        for level in mip_chain(image):
+            data = np.asarray(level)
+            if format in ENCODERS:
+                data = ENCODERS[format](image_blocks(data))
+            levels.append((level.width, level.height, data.reshape(-1)))
+        baked = BakedImage(format, levels)
+
+        entry = self.entry(file)
+        stat = os.stat(file)
+        index = dict(mtime=stat.st_mtime, size=stat.st_size,
+                     hash=file_hash(file), format=format, levels=[])
+        offset = 0
+        for width, height, data in levels:
+            index['levels'].append((width, height, offset, data.nbytes))
+            offset += data.nbytes
+        try:
+            os.makedirs(entry, exist_ok=True)
+            if os.path.exists(os.path.join(entry, 'index.json')):
+                os.remove(os.path.join(entry, 'index.json'))
+            # files are replaced, never rewritten in place: other processes
+            # may have the previous levels mapped
+            self.replace(entry, 'levels.bin',
+                         b''.join(data.tobytes() for _, _, data in levels))
+            # index is written last: its presence marks a complete entry
+            self.replace(entry, 'index.json', json.dumps(index).encode())
+        except OSError as error:
+            print('WARNING: unable to cache %s (%s)' % (file, error))
+        return baked
+
+    @staticmethod
+    def replace(entry, name, content):
+        """ atomically replace file name of entry by one with content """
+        handle, path = tempfile.mkstemp(dir=entry, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as temporary:
+                temporary.write(content)
+            os.replace(path, os.path.join(entry, name))
+        except OSError:
+            os.remove(path)
+            raise
+
+
+baker = TextureBaker()  # baker shared by the whole process
+
+
+# -------------- offline baking -----------------------------------------------
+def main():
+    """ bake textures ahead of time, in plain and S3TC formats both, as the
+        format used depends on the driver found at run time """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('files', nargs='+', help='source image files')
+    parser.add_argument('--plain', action='store_true',
+                        help='RGB8/RGBA8 only, for drivers without S3TC')
+    args = parser.parse_args()
+
+    for compress in (False,) if args.plain else (False, True):
+        baker.compress = compress
+        for file in args.files:
+            try:
+                baked = baker.load(file)
+            except OSError as error:
+                print('ERROR: unable to bake %s (%s)' % (file, error))
+                continue
+            print('Baked %s\t(%s, %d levels, %d bytes)'
+                  % (file, baked.format, len(baked.levels), baked.nbytes))
+
+
+if __name__ == '__main__':
+    main()
@@ -44,6 +44,29 @@ def lerpCircle(point_a, point_b, fraction):
     return result
 
 
+def batch_normalized(vectors):
+    """ normalized rows of vectors, zero rows being left as is """
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0., norms, 1.)
+
+
+def batch_lerpCircle(points_a, points_b, fractions):
+    """ lerpCircle of each row of points_a, points_b by fractions: rotation
+        of a, towards b around their cross product, by fraction of angle """
+    norms_a = np.linalg.norm(points_a, axis=-1)
+    norms_b = np.linalg.norm(points_b, axis=-1)
+    valid = (norms_a > 0) & (norms_b > 0)
+    costheta = np.einsum('ij,ij->i', points_a, points_b) \
+        / np.where(valid, norms_a * norms_b, 1.)
+    angles = (fractions * np.arccos(np.clip(costheta, -1, 1)))[:, None]
+    axis = batch_normalized(np.cross(points_a, points_b))
+    # Rodrigues' rotation formula, a being orthogonal to axis
+    result = points_a * np.cos(angles) + np.cross(axis, points_a) * np.sin(angles)
+    # null a or b is returned as is, like lerpCircle does
+    degenerate = np.where((norms_a > 0)[:, None], points_b, points_a)
+    return np.where(valid[:, None], result, degenerate)
+
+
 # Typical 4x4 matrix utilities for OpenGL ------------------------------------
 def identity():
     """ 4x4 identity matrix """
@@ -194,6 +217,29 @@ def quaternion_slerp(q0, q1, fraction):
     return q0*math.cos(theta) + q2*math.sin(theta)
 
 
+def batch_quaternion_matrix(quaternions):
+    """ rotation 3x3 matrices of each row of quaternions """
+    w, x, y, z = batch_normalized(quaternions).T
+    return np.stack([1 - 2*(y*y + z*z), 2*(x*y - w*z),     2*(x*z + w*y),
+                     2*(x*y + w*z),     1 - 2*(x*x + z*z), 2*(y*z - w*x),
+                     2*(x*z - w*y),     2*(y*z + w*x),     1 - 2*(x*x + y*y)],
+                    axis=-1).reshape(-1, 3, 3)
+
+
+def batch_quaternion_slerp(q0, q1, fractions):
+    """ quaternion_slerp of each row of q0, q1 by fractions """
+    q0, q1 = batch_normalized(q0), batch_normalized(q1)
+    dot = np.einsum('ij,ij->i', q0, q1)
+
+    # shorter path: reverse one quaternion if negative dot product
+    q1 = np.where((dot > 0)[:, None], q1, -q1)
+    dot = np.abs(dot)[:, None]
+
+    theta = np.arccos(np.clip(dot, -1, 1)) * fractions[:, None]
+    q2 = batch_normalized(q1 - q0*dot)
+    return q0*np.cos(theta) + q2*np.sin(theta)
+
+
 # a trackball class based on provided quaternion functions -------------------
 class Trackball:
     """Virtual trackball for 3D scene viewing. Independent of window system."""
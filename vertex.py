@@ -1,18 +1,229 @@
+import ctypes                       # byte offsets of index levels
 import OpenGL.GL as GL      # standard Python OpenGL wrapper
 import numpy as np                  # all matrix manipulations & OpenGL args
 from PIL import Image               # load images for textures
+import os                           # os function, i.e. checking file status
+from collections import OrderedDict # least recently used texture eviction
+
+from profiler import profiler
+from texbake import baker, TEXTURE_FORMATS
+
+def bounding_volumes(positions):
+    """ axis aligned box (lower, upper) & sphere (center, radius) of the
+        rows of a 2D or 3D position array """
+    dimension = min(positions.shape[1], 3)
+    positions, padded = np.zeros((len(positions), 3), np.float32), positions
+    positions[:, :dimension] = padded[:, :dimension]
+    lower, upper = positions.min(axis=0), positions.max(axis=0)
+    center = (lower + upper) / 2
+    radius = np.sqrt(((positions - center) ** 2).sum(axis=1).max())
+    return (lower, upper), (center, radius)
+
+
+# vertex attribute storage formats: numpy type, GL type, normalized or not
+VERTEX_FORMATS = {
+    'float': (np.float32, GL.GL_FLOAT, False),
+    'half': (np.float16, GL.GL_HALF_FLOAT, False),
+    'unorm16': (np.uint16, GL.GL_UNSIGNED_SHORT, True),  # [0, 1] values
+    'snorm16': (np.int16, GL.GL_SHORT, True),            # [-1, 1] values
+    'int2_10_10_10': (np.uint32, GL.GL_INT_2_10_10_10_REV, True),  # unit xyz
+}
+
+
+def pack_attribute(data, format):
+    """ rows of data converted to storage format, as (packed array, number
+        of components seen by the shader) """
+    dtype, _, _ = VERTEX_FORMATS[format]
+    data = np.asarray(data, np.float32)
+    if format == 'unorm16':
+        data = np.round(np.clip(data, 0, 1) * 65535)
+    elif format == 'snorm16':
+        data = np.round(np.clip(data, -1, 1) * 32767)
+    elif format == 'int2_10_10_10':  # x, y, z in 10 bits each, w is 0
+        signed = np.round(np.clip(data[:, :3], -1, 1) * 511).astype(np.int32)
+        bits = (signed & 0x3FF).astype(np.uint32)
+        packed = bits[:, 0] | bits[:, 1] << 10 | bits[:, 2] << 20
+        return packed[:, None], 4
+    return data.astype(dtype), data.shape[1]
+
+
+def texcoord_format(tex_uv):
+    """ compact format for texture coordinates: unit normalized 16 bits if
+        they all are in [0, 1], half floats if they wrap around """
+    if tex_uv is None:
+        return None
+    tex_uv = np.asarray(tex_uv)
+    inside = tex_uv.size == 0 or (tex_uv.min() >= 0 and tex_uv.max() <= 1)
+    return 'unorm16' if inside else 'half'
+
+
+def interleave(attributes):
+    """ one buffer of vertices from list of (rows, format) attributes, each
+        one 4 bytes aligned. Returns buffer as 2D bytes array, stride, and
+        (components, GL type, normalized, byte offset) of each attribute """
+    packed = [pack_attribute(data, format) for data, format in attributes]
+    widths = [-(-array[0].nbytes // 4) * 4 if len(array) else 0
+              for array, _ in packed]
+    stride = sum(widths)
+    buffer = np.zeros((len(packed[0][0]), stride), np.uint8)
+    pointers, offset = [], 0
+    for (array, components), width, (_, format) in zip(packed, widths,
+                                                        attributes):
+        rows = np.ascontiguousarray(array).view(np.uint8).reshape(len(array), -1)
+        buffer[:, offset:offset + rows.shape[1]] = rows
+        _, gl_type, normalized = VERTEX_FORMATS[format]
+        pointers.append((components, gl_type, normalized, offset))
+        offset += width
+    return buffer, stride, pointers
+
+
+class StreamBuffer:
+    """ Vertex attribute buffer rewritten between draws, without waiting for
+        the GPU to be done with previous contents. In 'ring' mode, draws
+        cycle through regions of a buffer allocated once, a region being
+        reused only after the fence of its last use, normally long passed.
+        Writes map the range they change only, rows left untouched since
+        the previous draw being copied forward from the previous region on
+        the GPU. In 'orphan' mode, writes of the whole capacity get fresh
+        storage from the driver, partial ones being ordered after draws """
+    def __init__(self, glid, data, mode='ring', regions=3):
+        self.glid, self.mode = glid, mode
+        self.capacity, self.row = data.shape[0], data.shape[1] * 4
+        self.size = self.capacity * self.row
+        self.regions = regions if mode == 'ring' else 1
+        self.region = 0
+        self.fences = [None] * self.regions
+        self.written = True  # initial data, region 0
+        self.source = None   # previous region while rows are left to copy
+        self.copied = None   # region read by a copy not yet fenced
+        self.dirty = []      # (start, end) rows written since region moved
+        GL.glBufferData(GL.GL_ARRAY_BUFFER, self.size * self.regions, None,
+                        GL.GL_STREAM_DRAW)
+        GL.glBufferSubData(GL.GL_ARRAY_BUFFER, 0, data.nbytes, data)
+
+    def write(self, data, offset=0):
+        """ write rows of data from row offset, buffer being bound. Returns
+            True if attribute now reads from another byte offset """
+        if self.mode == 'orphan':
+            if len(data) == self.capacity:  # nothing to keep: fresh storage
+                GL.glBufferData(GL.GL_ARRAY_BUFFER, self.size, data,
+                                GL.GL_STREAM_DRAW)
+            elif data.nbytes:  # ordered after draws reading previous rows
+                GL.glBufferSubData(GL.GL_ARRAY_BUFFER, offset * self.row,
+                                   data.nbytes, data)
+            profiler.count('uploaded bytes', data.nbytes)
+            return False
+
+        moved = False
+        if not self.written:  # first write since last draw: next region
+            self.source = self.region
+            self.region = (self.region + 1) % self.regions
+            self.wait(self.region)
+            self.dirty = []
+            self.written = moved = True
+        if data.nbytes:
+            start = self.region * self.size + offset * self.row
+            pointer = GL.glMapBufferRange(
+                GL.GL_ARRAY_BUFFER, start, data.nbytes, GL.GL_MAP_WRITE_BIT |
+                GL.GL_MAP_INVALIDATE_RANGE_BIT | GL.GL_MAP_UNSYNCHRONIZED_BIT)
+            ctypes.memmove(pointer, data.ctypes.data, data.nbytes)
+            GL.glUnmapBuffer(GL.GL_ARRAY_BUFFER)
+            self.dirty.append((offset, offset + len(data)))
+            profiler.count('uploaded bytes', data.nbytes)
+        return moved
+
+    def wait(self, region):
+        """ block until GPU is done with region, only if 2 frames late """
+        fence = self.fences[region]
+        if fence is not None:
+            GL.glClientWaitSync(fence, GL.GL_SYNC_FLUSH_COMMANDS_BIT,
+                                GL.GL_TIMEOUT_IGNORED)
+            self.fences[region] = None
+            if fence not in self.fences:  # may also guard the copy source
+                GL.glDeleteSync(fence)
+
+    def ready(self):
+        """ before a draw: copy forward the rows not written since region
+            moved, now that writes are done so the copy can't overwrite
+            them whatever the order the GPU sees them in """
+        if self.source is None:
+            return
+        rows, end = [], 0
+        for first, last in sorted(self.dirty) + [(self.capacity,) * 2]:
+            if first > end:
+                rows.append((end, first))
+            end = max(end, last)
+        GL.glBindBuffer(GL.GL_COPY_WRITE_BUFFER, self.glid)
+        for first, last in rows:
+            GL.glCopyBufferSubData(
+                GL.GL_COPY_WRITE_BUFFER, GL.GL_COPY_WRITE_BUFFER,
+                self.source * self.size + first * self.row,
+                self.region * self.size + first * self.row,
+                (last - first) * self.row)
+        GL.glBindBuffer(GL.GL_COPY_WRITE_BUFFER, 0)
+        self.copied, self.source = self.source, None
+
+    def drawn(self):
+        """ mark current contents as used by a draw just issued """
+        if self.written and self.mode == 'ring':
+            fence = GL.glFenceSync(GL.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+            # copy source region read by this frame too: same fence guards it
+            for region in {self.region, self.copied} - {None}:
+                old = self.fences[region]
+                self.fences[region] = fence
+                if old is not None and old not in self.fences:
+                    GL.glDeleteSync(old)
+            self.copied = None
+        self.written = False
+
+    def __del__(self):
+        for fence in set(self.fences) - {None}:
+            GL.glDeleteSync(fence)
+
 
 class VertexArray:
     """ helper class to create and self destroy OpenGL vertex array objects."""
-    def __init__(self, attributes, index=None, usage=GL.GL_STATIC_DRAW):
+    def __init__(self, attributes, index=None, usage=GL.GL_STATIC_DRAW,
+                 divisors=(), levels=(), layout=None, stream=(),
+                 stream_mode='ring'):
         """ Vertex array from attributes and optional index array. Vertex
-            Attributes should be list of arrays with one row per vertex. """
+            Attributes should be list of arrays with one row per vertex.
+            Attributes with a non zero divisor hold one row per instance.
+            Levels are optional coarser index arrays of the same vertices,
+            stored after index in the same buffer, drawn by level number.
+            Layout optionally gives the VERTEX_FORMATS name of each vertex
+            attribute, which are then interleaved in a single buffer.
+            Attributes whose index is in stream are rewritten with update,
+            up to their initial number of rows, see StreamBuffer """
 
         # create vertex array object, bind it
         self.glid = GL.glGenVertexArrays(1)
         GL.glBindVertexArray(self.glid)
         self.buffers = []  # we will store buffers in a list
         nb_primitives, size = 0, 0
+        self.box = self.sphere = None  # bounds, if positions not instanced
+        self.streams = {}  # attribute index => StreamBuffer
+
+        # single buffer of interleaved, packed vertex attributes
+        if layout:
+            used = [(loc, data, format) for loc, (data, format)
+                    in enumerate(zip(attributes, layout)) if data is not None]
+            buffer, stride, pointers = interleave([(data, format)
+                                                   for _, data, format in used])
+            nb_primitives = len(buffer)
+            if used[0][0] == 0 and nb_primitives:
+                self.box, self.sphere = bounding_volumes(
+                    np.asarray(used[0][1], np.float32))
+            self.buffers += [GL.glGenBuffers(1)]
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[-1])
+            GL.glBufferData(GL.GL_ARRAY_BUFFER, buffer, usage)
+            profiler.count('uploaded bytes', buffer.nbytes)
+            for (loc, _, _), (size, gl_type, normalized, offset) in zip(
+                    used, pointers):
+                GL.glEnableVertexAttribArray(loc)
+                GL.glVertexAttribPointer(loc, size, gl_type, normalized, stride,
+                                         ctypes.c_void_p(offset))
+            attributes = ()
 
         # load buffer per vertex attribute (in list with index = shader layout)
         for loc, data in enumerate(attributes):
@@ -20,33 +231,90 @@ class VertexArray:
                 # bind a new vbo, upload its data to GPU, declare size and type
                 self.buffers += [GL.glGenBuffers(1)]
                 data = np.array(data, np.float32, copy=False)  # ensure format
-                nb_primitives, size = data.shape
+                divisor = divisors[loc] if loc < len(divisors) else 0
+                if not divisor:
+                    nb_primitives = data.shape[0]
+                if loc == 0 and not any(divisors) and len(data):
+                    self.box, self.sphere = bounding_volumes(data)
+                size = data.shape[1]
                 GL.glEnableVertexAttribArray(loc)
                 GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[-1])
-                GL.glBufferData(GL.GL_ARRAY_BUFFER, data, usage)
+                if loc in stream:
+                    self.streams[loc] = StreamBuffer(self.buffers[-1], data,
+                                                     stream_mode)
+                else:
+                    GL.glBufferData(GL.GL_ARRAY_BUFFER, data, usage)
+                profiler.count('uploaded bytes', data.nbytes)
                 GL.glVertexAttribPointer(loc, size, GL.GL_FLOAT, False, 0, None)
+                if divisor:
+                    GL.glVertexAttribDivisor(loc, divisor)
 
         # optionally create and upload an index buffer for this object
         self.draw_command = GL.glDrawArrays
+        self.instanced_command = GL.glDrawArraysInstanced
         self.arguments = (0, nb_primitives)
+        self.levels = [self.arguments]
         if index is not None:
+            # 16 bits indices whenever the number of vertices allows
+            index_type, gl_index_type = (np.uint16, GL.GL_UNSIGNED_SHORT) \
+                if nb_primitives <= 1 << 16 else (np.uint32, GL.GL_UNSIGNED_INT)
             self.buffers += [GL.glGenBuffers(1)]
-            index_buffer = np.array(index, np.int32, copy=False)  # good format
+            indices = [np.asarray(level).astype(index_type, copy=False)
+                       for level in (index,) + tuple(levels)]
+            index_buffer = np.concatenate([level.ravel() for level in indices])
             GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, self.buffers[-1])
             GL.glBufferData(GL.GL_ELEMENT_ARRAY_BUFFER, index_buffer, usage)
+            profiler.count('uploaded bytes', index_buffer.nbytes)
             self.draw_command = GL.glDrawElements
-            self.arguments = (index_buffer.size, GL.GL_UNSIGNED_INT, None)
+            self.instanced_command = GL.glDrawElementsInstanced
+            self.levels, offset = [], 0
+            for level in indices:
+                self.levels.append((level.size, gl_index_type,
+                                    ctypes.c_void_p(offset) if offset else None))
+                offset += level.nbytes
+            self.arguments = self.levels[0]
 
         # cleanup and unbind so no accidental subsequent state update
         GL.glBindVertexArray(0)
         GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
         GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, 0)
 
-    def execute(self, primitive):
-        """ draw a vertex array, either as direct array or indexed array """
+    def update(self, attribute_index, array, offset=0):
+        """ write rows of array in streamed attribute, from row offset.
+            Other rows keep their values: only changed ranges need updates """
+        stream = self.streams[attribute_index]
+        data = np.ascontiguousarray(array, np.float32)
+        if offset < 0 or offset + len(data) > stream.capacity:
+            raise ValueError('rows %d to %d outside attribute %d capacity %d'
+                             % (offset, offset + len(data), attribute_index,
+                                stream.capacity))
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, stream.glid)
+        if stream.write(data, offset):  # attribute now reads another region
+            GL.glBindVertexArray(self.glid)
+            GL.glVertexAttribPointer(attribute_index, stream.row // 4,
+                                     GL.GL_FLOAT, False, 0,
+                                     ctypes.c_void_p(stream.region * stream.size))
+            GL.glBindVertexArray(0)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+
+    def execute(self, primitive, instances=None, level=0):
+        """ bind and draw a vertex array, see draw """
         GL.glBindVertexArray(self.glid)
-        self.draw_command(primitive, *self.arguments)
-        GL.glBindVertexArray(0)
+        self.draw(primitive, instances, level)
+
+    def draw(self, primitive, instances=None, level=0):
+        """ draw this already bound vertex array, either as direct array or
+            indexed array, optionally repeated for a number of instances in
+            one call """
+        profiler.count('draw calls')
+        for stream in self.streams.values():
+            stream.ready()
+        if instances is None:
+            self.draw_command(primitive, *self.levels[level])
+        else:
+            self.instanced_command(primitive, *self.levels[level], instances)
+        for stream in self.streams.values():
+            stream.drawn()
 
     def __del__(self):  # object dies => kill GL array and buffers from GPU
         GL.glDeleteVertexArrays(1, [self.glid])
@@ -55,23 +323,126 @@ class VertexArray:
 class Texture:
     """ Helper class to create and automatically destroy textures """
     def __init__(self, file, wrap_mode=GL.GL_REPEAT, min_filter=GL.GL_LINEAR,
-                 mag_filter=GL.GL_LINEAR_MIPMAP_LINEAR):
+                 mag_filter=GL.GL_LINEAR_MIPMAP_LINEAR, image=None):
+        """ image is the already baked content of file, if available """
         self.glid = GL.glGenTextures(1)
+        self.size = 0  # GPU memory in bytes, mip chain included
         try:
-            # imports image as a numpy array in exactly right format
-            tex = np.asarray(Image.open(file).convert('RGBA'))
+            # baked mip chain, uploaded level by level from the mapped cache
+            baked = baker.load(file) if image is None else image
+            internal, format, _, _ = TEXTURE_FORMATS[baked.format]
             GL.glBindTexture(GL.GL_TEXTURE_2D, self.glid)
-            GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA, tex.shape[1],
-                            tex.shape[0], 0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, tex)
+            GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)  # RGB8 rows unpadded
+            for level, (width, height, data) in enumerate(baked.levels):
+                if format is None:
+                    GL.glCompressedTexImage2D(GL.GL_TEXTURE_2D, level, internal,
+                                              width, height, 0, data)
+                else:
+                    GL.glTexImage2D(GL.GL_TEXTURE_2D, level, internal, width,
+                                    height, 0, format, GL.GL_UNSIGNED_BYTE, data)
+            GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 4)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAX_LEVEL,
+                               len(baked.levels) - 1)
             GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, wrap_mode)
             GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, wrap_mode)
             GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, min_filter)
             GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, mag_filter)
-            GL.glGenerateMipmap(GL.GL_TEXTURE_2D)
-            message = 'Loaded texture %s\t(%s, %s, %s, %s)'
-            print(message % (file, tex.shape, wrap_mode, min_filter, mag_filter))
-        except FileNotFoundError:
-            print("ERROR: unable to load texture file %s" % file)
+            self.size = baked.nbytes
+            profiler.count('uploaded bytes', baked.nbytes)
+            message = 'Loaded texture %s\t(%s, %s, %s, %s, %s)'
+            print(message % (file, baked.shape, baked.format, wrap_mode,
+                             min_filter, mag_filter))
+        except OSError as error:  # missing, unreadable or corrupt image
+            print("ERROR: unable to load texture file %s (%s)" % (file, error))
 
     def __del__(self):  # delete GL texture from GPU when object dies
         GL.glDeleteTextures(self.glid)
+
+
+
+class Sampler:
+    """ Helper class to create and automatically destroy sampler objects,
+        which hold wrap & filter state apart from the texture data """
+    def __init__(self, wrap_mode=GL.GL_REPEAT, min_filter=GL.GL_LINEAR,
+                 mag_filter=GL.GL_LINEAR_MIPMAP_LINEAR):
+        self.glid = GL.glGenSamplers(1)
+        GL.glSamplerParameteri(self.glid, GL.GL_TEXTURE_WRAP_S, wrap_mode)
+        GL.glSamplerParameteri(self.glid, GL.GL_TEXTURE_WRAP_T, wrap_mode)
+        # same parameter naming convention as Texture above
+        GL.glSamplerParameteri(self.glid, GL.GL_TEXTURE_MAG_FILTER, min_filter)
+        GL.glSamplerParameteri(self.glid, GL.GL_TEXTURE_MIN_FILTER, mag_filter)
+
+    def __del__(self):  # delete GL sampler from GPU when object dies
+        GL.glDeleteSamplers(1, [self.glid])
+
+
+samplers = {}  # (wrap, min, mag) => shared Sampler, see get_sampler
+
+
+def get_sampler(wrap_mode=GL.GL_REPEAT, min_filter=GL.GL_LINEAR,
+                mag_filter=GL.GL_LINEAR_MIPMAP_LINEAR):
+    """ sampler object for this sampling state, created on first use only """
+    key = (int(wrap_mode), int(min_filter), int(mag_filter))
+    if key not in samplers:
+        samplers[key] = Sampler(wrap_mode, min_filter, mag_filter)
+    return samplers[key]
+
+class TextureCache:
+    """ Shares textures between their users, deduplicated by resolved file
+        path, modification time and sampling parameters. Textures nobody uses
+        anymore stay cached for reuse, and are evicted least recently used
+        first whenever the total size exceeds the GPU memory budget. """
+    def __init__(self, budget=512 * 1024 * 1024):
+        self.budget = budget           # in bytes, may be changed at any time
+        self.size = 0                  # bytes held by all cached textures
+        self.textures = {}             # key => texture
+        self.users = {}                # key => number of users of texture
+        self.unused = OrderedDict()    # key => texture without user, LRU first
+
+    @staticmethod
+    def key(file, wrap_mode, min_filter, mag_filter):
+        """ identity of a texture: same file content and sampling state """
+        path = os.path.realpath(file)
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        return path, mtime, int(wrap_mode), int(min_filter), int(mag_filter)
+
+    def acquire(self, file, wrap_mode=GL.GL_REPEAT, min_filter=GL.GL_LINEAR,
+                mag_filter=GL.GL_LINEAR_MIPMAP_LINEAR, image=None):
+        """ shared Texture for these parameters, loaded on first request,
+            from image if given (decoded content of file) """
+        key = self.key(file, wrap_mode, min_filter, mag_filter)
+        texture = self.textures.get(key)
+        if texture is None:
+            texture = Texture(file, wrap_mode, min_filter, mag_filter, image)
+            texture.key = key
+            self.textures[key], self.users[key] = texture, 0
+            self.size += texture.size
+        self.unused.pop(key, None)
+        self.users[key] += 1
+        self.evict()
+        return texture
+
+    def __contains__(self, file):
+        """ whether file is cached with default sampling state """
+        return self.key(file, GL.GL_REPEAT, GL.GL_LINEAR,
+                        GL.GL_LINEAR_MIPMAP_LINEAR) in self.textures
+
+    def release(self, texture):
+        """ give back a texture obtained with acquire """
+        key = getattr(texture, 'key', None)
+        if self.textures.get(key) is not texture:
+            return
+        self.users[key] -= 1
+        if self.users[key] <= 0:
+            self.unused[key] = texture
+            self.evict()
+
+    def evict(self):
+        """ drop unused textures, oldest first, until back within budget """
+        while self.size > self.budget and self.unused:
+            key, texture = self.unused.popitem(last=False)
+            del self.textures[key], self.users[key]
+            self.size -= texture.size
+
+
+textures = TextureCache()  # texture cache shared by the whole process
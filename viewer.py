@@ -24,10 +24,17 @@ from bisect import bisect_left
 from itertools import cycle
 
 from space import SystemeSolaire
-from node import Node
+from loader import assets
+from clock import clock
+from profiler import profiler
+from render import queue
+from resolver import resolver
+from texbake import baker
+from node import Node, Scene
 from projectile import *
 from skybox import *
 from particlesbis import *
+from gpuparticles import GPUParticleGenerator
 
 # ------------ low level OpenGL object wrappers ----------------------------
 
@@ -120,18 +127,18 @@ void main() {
 TEXTURE_PARTICLE_VERT = """#version 330 core
 
 uniform mat4 projection;
-uniform vec2 offset;
-uniform vec4 color;
 
 layout(location = 0) in vec2 position;
 layout(location = 1) in vec2 texCoords;
+layout(location = 2) in vec3 offset;    // per instance attributes
+layout(location = 3) in vec4 color;
 
 out vec2 fragTexCoord;
 out vec4 particleColor;
 
 void main() {
     float scale = 10.0f;
-    gl_Position = projection * vec4((position * scale) + offset, 0.0, 1.0);
+    gl_Position = projection * vec4((position * scale) + offset.xy, 0.0, 1.0);
     particleColor = color;
     fragTexCoord = texCoords;
 }"""
@@ -219,6 +226,17 @@ class Viewer:
         # register event handlers
         glfw.set_key_callback(self.win, self.on_key)
 
+        self.init_gl()
+
+        # initialize trackball
+        self.trackball = GLFWTrackball(self.win)
+
+        # cyclic iterator to easily toggle polygon rendering modes
+        self.fill_modes = cycle([GL.GL_LINE, GL.GL_POINT, GL.GL_FILL])
+        self.overlay = False  # profiler summary in window title
+
+    def init_gl(self):
+        """ default render state & shaders, once a GL context is current """
         # useful message to check OpenGL renderer characteristics
         print('OpenGL', GL.glGetString(GL.GL_VERSION).decode() + ', GLSL',
               GL.glGetString(GL.GL_SHADING_LANGUAGE_VERSION).decode() +
@@ -229,44 +247,83 @@ class Viewer:
         GL.glEnable(GL.GL_DEPTH_TEST)         # depth test now enabled (TP2)
         GL.glEnable(GL.GL_CULL_FACE)          # backface culling enabled (TP2)
 
+        # bake textures compressed only if the driver can sample them
+        baker.detect()
+
         # compile and initialize shader programs once globally
-        self.color_shader = Shader(COLOR_VERT, COLOR_FRAG)
-        self.texture_shader_skybox = Shader(TEXTURE_SKYBOX_VERT, TEXTURE_SKYBOX_FRAG)
-        self.texture_shader_particle = Shader(TEXTURE_PARTICLE_VERT, TEXTURE_PARTICLE_FRAG)
+        self.color_shader = shaders.acquire(COLOR_VERT, COLOR_FRAG)
+        self.texture_shader_skybox = shaders.acquire(TEXTURE_SKYBOX_VERT, TEXTURE_SKYBOX_FRAG)
+        self.texture_shader_particle = shaders.acquire(TEXTURE_PARTICLE_VERT, TEXTURE_PARTICLE_FRAG)
 
         # initially empty list of object to draw
         self.drawables = []
 
-        # initialize trackball
-        self.trackball = GLFWTrackball(self.win)
-
-        # cyclic iterator to easily toggle polygon rendering modes
-        self.fill_modes = cycle([GL.GL_LINE, GL.GL_POINT, GL.GL_FILL])
-        
-    def run(self, lastFrame=0):
-        """ Main render loop for this OpenGL window """
-        while not glfw.window_should_close(self.win):
-            # clear draw buffer and depth buffer (<-TP2)
-            GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
-
-            currentFrame = glfw.get_time()
-            deltaTime = currentFrame - lastFrame
-            lastFrame = currentFrame
-            for d in self.drawables:
-                if isinstance(d, ParticleGenerator):
-                    d.update(dt=deltaTime)
-
-            winsize = glfw.get_window_size(self.win)
-            view = self.trackball.view_matrix()
-            projection = self.trackball.projection_matrix(winsize)
-
-            # draw our scene objects
-            for drawable in self.drawables:
-                drawable.draw(projection, view, identity(),
+        # same root matrix object every frame: lets scenes keep their world
+        # matrices while static
+        self.model = identity()
+
+    def update(self):
+        """ advance simulation state of all drawables by one clock step """
+        clock.advance()
+        for d in self.drawables:
+            if isinstance(d, (ParticleGenerator, GPUParticleGenerator)):
+                d.update(dt=clock.step)
+            if isinstance(d, Scene):
+                d.update(clock.get_time(), self.win)
+
+    def simulate(self, duration):
+        """ advance simulation by duration seconds, without rendering """
+        for _ in range(int(round(duration / clock.step))):
+            self.update()
+
+    def frame(self, winsize):
+        """ run simulation steps due since last frame, then render it """
+        profiler.begin_frame()
+        with profiler.scope('update'):
+            for _ in range(clock.tick()):
+                self.update()
+        self.render(winsize)
+        profiler.end_frame()
+
+    def render(self, winsize):
+        """ draw one frame of all drawables, at current clock time """
+        # clear draw buffer and depth buffer (<-TP2)
+        GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
+
+        view = self.trackball.view_matrix()
+        projection = self.trackball.projection_matrix(winsize)
+
+        # view derived matrices, computed once for the whole frame
+        invview, viewprojection = np.linalg.inv(view), projection @ view
+
+        # draw our scene objects
+        for drawable in self.drawables:
+            with profiler.scope('draw %s' % type(drawable).__name__):
+                drawable.draw(projection, view, self.model,
                               color_shader=self.color_shader,
                               win=self.win,
                               texture_shader_skybox=self.texture_shader_skybox, 
-                              texture_shader_particle=self.texture_shader_particle)
+                              texture_shader_particle=self.texture_shader_particle,
+                              invview=invview, viewprojection=viewprojection)
+
+        # draw items submitted by drawables, sorted by pass & state
+        with profiler.scope('flush'):
+            queue.flush()
+
+        # upload some of the assets loaded in background since last frame
+        with profiler.scope('uploads'):
+            assets.process()
+
+    def run(self):
+        """ Main render loop for this OpenGL window """
+        shown = 0  # last profiler overlay update time
+        while not glfw.window_should_close(self.win):
+            self.frame(glfw.get_window_size(self.win))
+
+            # profiler summary shown in title, refreshed twice a second
+            if self.overlay and glfw.get_time() - shown > 0.5:
+                shown = glfw.get_time()
+                glfw.set_window_title(self.win, 'Viewer - ' + profiler.summary())
 
             # flush render commands, and swap draw buffers
             glfw.swap_buffers(self.win)
@@ -275,23 +332,36 @@ class Viewer:
             glfw.poll_events()
 
     def add(self, *drawables):
-        """ add objects to draw in this window """
-        self.drawables.extend(drawables)
+        """ add objects to draw in this window, node trees being compiled
+            to scenes with batched world matrices propagation """
+        self.drawables.extend(Scene(drawable) if isinstance(drawable, Node)
+                              else drawable for drawable in drawables)
 
     def on_key(self, _win, key, _scancode, action, _mods):
-        """ 'Q' or 'Escape' quits """
+        """ 'Q' or 'Escape' quits, 'P' pauses, 'N' steps, '+'/'-' scale
+            simulation speed, 'F' shows frame statistics """
         if action == glfw.PRESS or action == glfw.REPEAT:
             if key == glfw.KEY_ESCAPE or key == glfw.KEY_Q:
                 glfw.set_window_should_close(self.win, True)
             if key == glfw.KEY_W:
                 GL.glPolygonMode(GL.GL_FRONT_AND_BACK, next(self.fill_modes))
-            if key == glfw.KEY_SPACE: glfw.set_time(0)
+            if key == glfw.KEY_SPACE: clock.reset()
+            if key == glfw.KEY_P: clock.pause()
+            if key == glfw.KEY_F:
+                self.overlay = not self.overlay
+                if not self.overlay:
+                    glfw.set_window_title(self.win, 'Viewer')
+            if key == glfw.KEY_N: clock.single_step()
+            if key in (glfw.KEY_KP_ADD, glfw.KEY_EQUAL):
+                clock.set_scale(clock.scale * 2)
+            if key in (glfw.KEY_KP_SUBTRACT, glfw.KEY_MINUS):
+                clock.set_scale(clock.scale / 2)
 
 
 # -------------- main program and scene setup --------------------------------
-def main():
-    """ create a window, add scene objects, then run rendering loop """
-    viewer = Viewer()
+def populate(viewer):
+    """ add the solar system scene objects to viewer """
+    resolver.add_root('objet3D')  # all models share one texture search index
 
     file = ["ame_nebula/right.tga", "ame_nebula/left.tga", "ame_nebula/top.tga", 
     "ame_nebula/bottom.tga", "ame_nebula/front.tga", "ame_nebula/back.tga"]
@@ -302,6 +372,12 @@ def main():
 
     system = SystemeSolaire()
     viewer.add(system)
+
+
+def main():
+    """ create a window, add scene objects, then run rendering loop """
+    viewer = Viewer()
+    populate(viewer)
     viewer.run()
 
 